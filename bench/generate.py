@@ -0,0 +1,164 @@
+# Generates synthetic URCL programs for benchmarking. Opcodes and operand
+# shapes are read from UTRX files, and only forms that urcl2isa/urcl.utrx can
+# expand are used. Run from the repository root:
+#   python bench/generate.py -n 100000 -m "basic=3,complex=1,MLT=2" -o big.urcl
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "urcl2isa"))
+
+from program import Program
+from translator import Translator
+from cache import ExpansionCache
+from UTRX import Translation
+
+sources = ["urcl/basic.utrx", "urcl/complex.utrx"]
+immediates = ["0", "1", "5", "200", "@MAX", "@MSB", "@BITS", "M4"]
+# Operands of every instruction as URCL defines them, which some cases in the
+# tables don't follow, like 'JMP :: A A'. Whatever an instruction writes to is
+# an R, so it's always a register.
+standard = {
+    "R A A": ["ADD", "SUB", "MLT", "DIV", "SDIV", "MOD", "AND", "OR", "XOR", "NOR", "NAND", "XNOR",
+              "BSL", "BSR", "BSS", "LLOD", "SETE", "SETNE", "SETG", "SETL", "SETGE", "SETLE",
+              "SETC", "SETNC", "SSETG", "SSETL", "SSETGE", "SSETLE"],
+    "R A": ["MOV", "INC", "DEC", "NEG", "NOT", "LSH", "RSH", "SRS", "LOD"],
+    "R I": ["IMM"],
+    "R O": ["IN"],
+    "O A": ["OUT"],
+    "A A A": ["BGE", "BRL", "BRG", "BRE", "BNE", "BLE", "BRC", "BNC", "SBRL", "SBRG", "SBLE", "SBGE", "LSTR"],
+    "A A": ["BRZ", "BNZ", "BRN", "BRP", "BOD", "BEV", "STR", "CPY"],
+    "A": ["JMP", "PSH", "CAL"],
+    "R": ["POP"],
+    "": ["RET", "HLT", "NOP"],
+}
+shapes = {opcode: shape.split() for shape,names in standard.items() for opcode in names}
+
+def parseMix(mix: str):
+    weights: dict[str, float] = {}
+    for item in mix.split(","):
+        if item.strip():
+            key, weight = item.split("=")
+            weights[key.strip()] = float(weight)
+    return weights
+
+def opcodes(files: list[str], mix: dict[str, float]):
+    # Maps each opcode to (weight, parameters of its standard form, or of its
+    # first case if it hasn't got one). An opcode belongs to the first file
+    # that has it, file weights are shared out over their opcodes and opcode
+    # weights replace that
+    forms: dict[str, tuple[float, list[str]]] = {}
+    for filename in files:
+        group = os.path.splitext(os.path.basename(filename))[0]
+        translations = Translation.parseFile(filename)
+        new = [t for t in translations.values() if t.opcode not in forms and t.cases]
+        for translation in new:
+            weight = mix.get(group, 1.0) / len(new)
+            params = shapes.get(translation.opcode, translation.cases[0].params)
+            forms[translation.opcode] = (mix.get(translation.opcode, weight), params)
+    return {opcode: form for opcode,form in forms.items() if form[0] > 0}
+
+class Checker():
+    # Whether a line expands, remembered per expansion cache signature as that
+    # holds everything matching a case depends on
+    def __init__(self, translator: Translator):
+        self.translator = translator
+        self.keys = ExpansionCache(exact=True)
+        self.known: dict[tuple, bool] = {}
+
+    def expands(self, line: str):
+        try:
+            program = Program.parse([line])
+        except Exception:
+            return False
+        key = self.keys.signature(program.code[0])
+        ok = self.known.get(key)
+        if ok is None:
+            try:
+                self.translator.translate(program).makeRegsNumeric()
+                ok = True
+            except Exception:
+                ok = False
+            self.known[key] = ok
+        return ok
+
+def generate(size: int, mix: "dict[str, float] | None"=None, labels: float=0.05, relatives: float=0.05,
+             registers: int=8, seed: int=0, files: list[str]=sources, translator: "Translator | None"=None):
+    # Returns the lines of a program with size instructions
+    rng = random.Random(seed)
+    if translator is None:
+        translator = Translator.fromFile("urcl2isa/urcl.utrx", flat=True)
+    forms = opcodes(files, mix or {})
+    labelCount = max(1, int(size * labels))
+    R = lambda: f"R{rng.randint(1, registers)}"
+    I = lambda: rng.choice(immediates)
+
+    def operand(param: str, i: int, first: bool, branch: bool):
+        if first and branch:
+            if rng.random() < relatives and i + 3 < size:
+                return f"~+{rng.randint(1, 3)}"
+            if rng.random() < relatives and i >= 3:
+                return f"~-{rng.randint(1, 3)}"
+            return f".L{rng.randrange(labelCount)}"
+        if "O" in param:
+            return f"%{rng.randint(1, 8)}"
+        if "A" in param:
+            return R() if rng.random() < 0.7 else I()
+        if "R" in param:
+            return R()
+        return I()
+
+    def form(opcode: str, params: list[str], i: int):
+        params = [p for p in params if p not in ["==", "~~", "<>", "!=", "!~"]]
+        branch = bool(params) and params[0] == "A" and opcode.startswith(("B", "SB", "JMP", "CAL"))
+        args = [operand(p, i, a == 0, branch) for a,p in enumerate(params)]
+        return " ".join([opcode] + args)
+
+    # Leave out opcodes the URCL table can't expand in any form that was tried,
+    # and skip the forms of the others that it can't
+    checker = Checker(translator)
+    usable = {}
+    for opcode,(weight,params) in forms.items():
+        if any(checker.expands(form(opcode, params, size // 2)) for _ in range(16)):
+            usable[opcode] = (weight, params)
+        else:
+            print(f"Leaving out {opcode} :: {' '.join(params)}, it doesn't expand", file=sys.stderr)
+    names = list(usable)
+    weights = [usable[name][0] for name in names]
+    placed = sorted(rng.sample(range(size), min(labelCount, size)))
+
+    lines: list[str] = []
+    p = 0
+    for i in range(size):
+        while p < len(placed) and placed[p] == i:
+            lines.append(f".L{p}")
+            p += 1
+        while True:
+            opcode = rng.choices(names, weights)[0]
+            line = form(opcode, usable[opcode][1], i)
+            if checker.expands(line):
+                break
+        lines.append(line)
+    return lines
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", "--Size", help="How many instructions to generate", type=int, default=1000)
+    p.add_argument("-m", "--Mix", help="Weights of UTRX files and opcodes, like 'basic=3,complex=1,MLT=2'", default="")
+    p.add_argument("-l", "--Labels", help="Labels per instruction", type=float, default=0.05)
+    p.add_argument("-r", "--Relatives", help="Share of branches that use relative jumps", type=float, default=0.05)
+    p.add_argument("-g", "--Registers", help="How many registers to use", type=int, default=8)
+    p.add_argument("-s", "--Seed", help="Random seed", type=int, default=0)
+    p.add_argument("-o", "--Output", help="File to store the program in, stdout if not given")
+    argv = p.parse_args()
+
+    lines = generate(argv.Size, parseMix(argv.Mix), argv.Labels, argv.Relatives, argv.Registers, argv.Seed)
+    if argv.Output:
+        with open(argv.Output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+if __name__ == "__main__":
+    main()
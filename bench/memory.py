@@ -0,0 +1,54 @@
+# Memory use of a full translation: peak RSS of the process, peak traced
+# allocation size, and how many memory blocks each stage leaves allocated.
+# Run from the repository root:
+#   python bench/memory.py -f prog/example.urcl -t urcl/core.utrx
+import argparse
+import os
+import resource
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "urcl2isa"))
+
+from program import Program
+from translator import Translator
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("-f", "--File", help="URCL file to be translated", required=True)
+    p.add_argument("-t", "--Target", help="UTRX file containing translations", default="urcl/core.utrx")
+    p.add_argument("-n", "--NoTrace", help="Skip tracemalloc, which slows everything down", action="store_true")
+    argv = p.parse_args()
+
+    translator = Translator.fromFile("urcl2isa/urcl.utrx", flat=True)
+    translatorISA = Translator.fromFile(argv.Target)
+
+    if not argv.NoTrace:
+        tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    stages = []
+
+    main = Program.parseFile(argv.File)
+    stages.append(("parse", sys.getallocatedblocks() - blocks))
+    main = translator.translate(main)
+    stages.append(("translate", sys.getallocatedblocks() - blocks))
+    main.makeRegsNumeric()
+    main.relativesToLabels()
+    stages.append(("registers and labels", sys.getallocatedblocks() - blocks))
+    out = translatorISA.translateISA(main)
+    stages.append(("ISA", sys.getallocatedblocks() - blocks))
+
+    print(f"{argv.File}: {len(main.code)} core instructions, {len(out)} blocks")
+    for name,count in stages:
+        print(f"{'Blocks after ' + name:<34}{count:>12}")
+    if not argv.NoTrace:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"{'Peak traced allocations (KiB)':<34}{peak // 1024:>12}")
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    print(f"{'Peak RSS (KiB)':<34}{rss:>12}")
+
+if __name__ == "__main__":
+    main()
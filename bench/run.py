@@ -0,0 +1,130 @@
+# Times each stage of a translation on generated workloads, measures their
+# peak memory, and compares both against a stored baseline. Exits with 1 if
+# anything got slower or bigger than the tolerance allows. Run from the
+# repository root:
+#   python bench/run.py                 compare against bench/baseline.json
+#   python bench/run.py --save          record a new baseline
+# Timings only compare meaningfully with a baseline from the same machine.
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "urcl2isa"))
+
+from program import Program
+from translator import Translator
+from generate import generate, parseMix
+
+stages = ["parse", "expansion", "register numbering", "label conversion", "ISA emission"]
+
+def pipeline(lines: list[str], target: str):
+    # Yields after each stage, so the caller can measure around it
+    translator = Translator.fromFile("urcl2isa/urcl.utrx", flat=True)
+    translatorISA = Translator.fromFile(target)
+    yield
+    main = Program.parse(lines)
+    yield
+    main = translator.translate(main)
+    yield
+    main.makeRegsNumeric()
+    yield
+    main.relativesToLabels()
+    yield
+    translatorISA.translateISA(main)
+    yield
+
+def measure(lines: list[str], target: str, repeats: int):
+    # Best time of every stage, then its peak memory on a traced run. Like
+    # timeit, the garbage collector is kept out of the timings.
+    times = [float("inf")] * len(stages)
+    for r in range(repeats):
+        run = pipeline(lines, target)
+        next(run)
+        gc.collect()
+        gc.disable()
+        for s in range(len(stages)):
+            start = timer()
+            next(run)
+            times[s] = min(times[s], timer() - start)
+        gc.enable()
+        run = None
+    peaks = []
+    tracemalloc.start()
+    run = pipeline(lines, target)
+    next(run)
+    for s in range(len(stages)):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        next(run)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return {stage: {"time": times[s], "peak": peaks[s]} for s,stage in enumerate(stages)}
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", "--Sizes", help="Comma separated workload sizes in instructions", default="1000,10000,100000")
+    p.add_argument("-m", "--Mix", help="Opcode mix for the generator, see bench/generate.py", default="")
+    p.add_argument("-t", "--Target", help="UTRX file to emit", default="urcl/core.utrx")
+    p.add_argument("-r", "--Repeats", help="Runs to take the best time of", type=int, default=3)
+    p.add_argument("-b", "--Baseline", help="Baseline file", default=os.path.join(here, "baseline.json"))
+    p.add_argument("--TimeTolerance", help="Allowed slowdown, as a fraction", type=float, default=0.5)
+    p.add_argument("--MemoryTolerance", help="Allowed memory growth, as a fraction", type=float, default=0.1)
+    p.add_argument("--save", help="Store the results as the new baseline", action="store_true")
+    argv = p.parse_args()
+
+    baseline = {}
+    if os.path.exists(argv.Baseline):
+        with open(argv.Baseline, "r") as f:
+            baseline = json.load(f)
+    workloads = baseline.setdefault("workloads", {})
+
+    regressions = []
+    for size in map(int, argv.Sizes.split(",")):
+        key = f"n={size} mix={argv.Mix} target={argv.Target}"
+        lines = generate(size, parseMix(argv.Mix))
+        results = measure(lines, argv.Target, argv.Repeats)
+        base = workloads.get(key)
+        print(f"-"*30)
+        print(key)
+        print(f"{'stage':<20}{'ms':>10}{'base':>10}{'change':>9}{'peak KiB':>12}{'base':>10}{'change':>9}")
+        for stage in stages:
+            result = results[stage]
+            line = f"{stage:<20}{result['time']*1000:>10.2f}"
+            if base is None:
+                line += f"{'':>19}{result['peak']//1024:>12}"
+            else:
+                old = base[stage]
+                timeChange = result["time"] / old["time"] - 1 if old["time"] else 0
+                peakChange = result["peak"] / old["peak"] - 1 if old["peak"] else 0
+                line += f"{old['time']*1000:>10.2f}{timeChange:>+9.0%}{result['peak']//1024:>12}{old['peak']//1024:>10}{peakChange:>+9.0%}"
+                # A millisecond of slack keeps tiny stages from failing on noise
+                if result["time"] > old["time"] * (1 + argv.TimeTolerance) + 0.001:
+                    regressions.append(f"{key}: {stage} time {timeChange:+.0%}")
+                if result["peak"] > old["peak"] * (1 + argv.MemoryTolerance) + 1024:
+                    regressions.append(f"{key}: {stage} peak memory {peakChange:+.0%}")
+            print(line)
+        if argv.save:
+            workloads[key] = results
+    print(f"-"*30)
+
+    if argv.save:
+        baseline["machine"] = f"{platform.python_implementation()} {platform.python_version()} on {platform.machine()}"
+        with open(argv.Baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Baseline saved to {argv.Baseline}")
+        return
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No regressions.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Runs a URCL file as it's written and as the core URCL it's lowered to, and
+# compares what each wrote to its ports, so a translation that changes what a
+# program does shows up. If either stops at the limit, only what both wrote
+# is compared. Prints how many instructions of each opcode ran, and
+# the cycles the core code takes on a target. Exits with 1 if the outputs
+# differ, and with 2 if either can't be run, like a write to an immediate.
+# Run from the repository root:
+#   python bench/simulate.py -f prog/x.urcl -t isa/example.utrx
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "urcl2isa"))
+
+from program import Program
+from translator import Translator
+from simulator import Simulator
+
+def agrees(before: Simulator, after: Simulator):
+    # What both wrote has to be the same, and a run that halted wrote all it
+    # ever will, so the other can't have written more
+    for port in set(before.output) | set(after.output):
+        a, b = before.output.get(port, []), after.output.get(port, [])
+        length = min(len(a), len(b))
+        if a[:length] != b[:length]:
+            return False
+        if before.halted and len(b) > len(a) or after.halted and len(a) > len(b):
+            return False
+    return True
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("-f", "--File", help="URCL file to run", required=True)
+    p.add_argument("-t", "--Target", help="UTRX file to take the cost of core instructions from", default="urcl/core.utrx")
+    p.add_argument("-w", "--WordSize", help="The size of a word, unless the file has a BITS header", type=int, default=8)
+    p.add_argument("-l", "--Limit", help="Most instructions to run", type=int, default=10_000_000)
+    p.add_argument("-j", "--JSON", help="Print the results as JSON", action="store_true")
+    argv = p.parse_args()
+
+    translator = Translator.fromFile("urcl2isa/urcl.utrx", flat=True)
+    translatorISA = Translator.fromFile(argv.Target)
+
+    source = Program.parseFile(argv.File)
+    core = translator.translate(Program.parseFile(argv.File))
+    core.makeRegsNumeric()
+    core.relativesToLabels()
+
+    try:
+        before = Simulator(source, argv.WordSize).run(argv.Limit)
+        after = Simulator(core, argv.WordSize)
+    except ValueError as e:
+        if argv.JSON:
+            print(json.dumps({"file": argv.File, "target": argv.Target, "skipped": str(e)}, indent=2))
+        else:
+            print(f"Skipping {argv.File}: {e}")
+        sys.exit(2)
+    after.cost(translatorISA)
+    after.run(argv.Limit)
+    same = agrees(before, after)
+
+    if argv.JSON:
+        report = {
+            "file": argv.File,
+            "target": argv.Target,
+            "same": same,
+        }
+        for name,sim in [("source", before), ("core", after)]:
+            report[name] = {
+                "executed": sim.executed,
+                "halted": sim.halted,
+                "seconds": sim.time,
+                "cycles": sim.cycles(),
+                "opcodes": sim.perOpcode(),
+                "output": sim.output,
+            }
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Source: {before.toString()}")
+        print(f"Core: {after.toString()}")
+        print("Outputs are the same." if same else "Outputs differ!")
+    sys.exit(0 if same else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,20 @@
-from typing import TYPE_CHECKING
-if TYPE_CHECKING:
-  from operand import Operand
-  from translator import Translation
-import copy
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Registers
+import re
 
-class Case():
-  alphabet = "QWERTYUIOPASDFGHJKLZXCVBNM"
-  prefixes = ["!", "$", ">", "<"]
-  typeClasses = {
-    "A": ["RVSNGZPIMLCO"],
-    "R": ["VSNGZP"],
-    "I": ["MLCZO"],
-    "G": ["VSNP"],
-    "P": ["S"]
-  }
-  types = "ARVSNGZPIMLCO"
+class Pattern():
+  # A Case parameter compiled once from the parameter mini-language. Value
+  # tests ($value$, >n and <n) are kept in the order they're written, since any
+  # of them can end the match early, and type class letters are kept as
+  # (letter, inverted) pairs of which at least one has to hold.
+  __slots__ = ("param", "checks", "types", "typeOnly", "typeClasses")
 
-  def __init__(self, params: str, body: list[str], language="URCL"):
-    self.params = copy.deepcopy(params).split()
-    self.string = copy.deepcopy(params)
-    self.code = copy.deepcopy(body)
-    self.language = copy.deepcopy(language)
-
-  @staticmethod
-  def match(operand: "Operand", param: str):
+  def __init__(self, param: str):
+    self.param = param
+    self.checks: list[tuple] = []
+    self.types: list[tuple[str, bool]] = []
     invert = False
-    typeMatch = False
     readNum = False
     readStr = False
     num = ""
@@ -41,8 +30,7 @@ class Case():
       if readStr and (c == len(param)-1 or char in "$"):
         if char not in "$":
           readStr = False
-        if (str(operand.value) != s) != invert:
-          return False
+        self.checks.append(("$", s, invert))
         s = ""
         continue
       if readStr:
@@ -51,36 +39,365 @@ class Case():
         num += char
       if readNum and (c == len(param)-1 or not param[c+1].isnumeric()):
         readNum = False
-        if sym == ">":
-          if (int(operand.value) <= int(num)) != invert:
-            return False
-        if sym == "<":
-          if (int(operand.value) >= int(num)) != invert:
-            return False
+        if sym in [">", "<"]:
+          try:
+            bound = int(num)
+          except ValueError:
+            # Left as a string so that matching raises just like it used to
+            bound = num
+          self.checks.append((sym, bound, invert))
         num = ""
         continue
       if readNum:
         continue
       if char == "!":
         invert = not invert
-      if char in Case.types and not typeMatch:
-        if (char in operand.typeClass) != invert:
-          typeMatch = True
-          continue
+      if char in Case.types:
+        self.types.append((char, invert))
+        continue
       if char in "<>":
         sym = char
         readNum = True
         continue
 
-    return typeMatch
+    # Patterns without value tests only depend on the type class
+    self.typeOnly = not self.checks
+    self.typeClasses: dict[str, bool] = {}
+
+  def match(self, operand: "Operand"):
+    if self.typeOnly:
+      hit = self.typeClasses.get(operand.typeClass)
+      if hit is None:
+        hit = self.matchType(operand.typeClass)
+        self.typeClasses[operand.typeClass] = hit
+      return hit
+    for sym,arg,invert in self.checks:
+      if sym == "$":
+        if (str(operand.value) != arg) != invert:
+          return False
+      elif sym == ">":
+        if (int(operand.value) <= int(arg)) != invert:
+          return False
+      elif sym == "<":
+        if (int(operand.value) >= int(arg)) != invert:
+          return False
+    return self.matchType(operand.typeClass)
+
+  def matchType(self, typeClass: str):
+    for char,invert in self.types:
+      if (char in typeClass) != invert:
+        return True
+    return False
+
+
+class Body():
+  # A case body parsed once into instruction templates. Every operand is a slot:
+  #   ("ph", i)              operand i of the instruction being expanded
+  #   ("tmp", operand)       a literal register other than R0, a fresh temporary
+  #   ("const", operand)     a word size constant such as @MAX
+  #   ("lit", operand)       any other literal operand, shared as it is
+  # A final body is all core URCL, none of it expands any further.
+  __slots__ = ("code", "final")
+
+  def __init__(self, code: tuple, final: bool=False):
+    self.code = code
+    self.final = final
+
+  @staticmethod
+  def parse(lines: list[str]):
+    program = Program.parse(lines, None)
+    code = []
+    for ins in program.code:
+      slots = []
+      for opr in ins.operands:
+        if opr.type == OpType.OTHER and opr.value.isalpha() and len(opr.value) == 1:
+          slots.append(("ph", ord(opr.value)-65))
+        elif opr.type == OpType.OTHER and Program.constant(opr.value) is not None:
+          slots.append(("const", opr))
+        elif opr.type == OpType.REGISTER and opr.value != 0:
+          slots.append(("tmp", opr))
+        else:
+          slots.append(("lit", opr))
+      code.append((ins.opcode, tuple(ins.labels), tuple(slots)))
+    return Body(tuple(code))
+
+  def instantiate(self, operands: list["Operand"], registers: "Registers", wordSize: int=8):
+    # Builds the sub-program for an expansion: placeholders are bound to the
+    # expanded instruction's own operands, and every literal register but R0
+    # becomes a fresh temporary. Type classes stay the ones of the literals.
+    temps: dict[int, int] = {}
+    code: list[Instruction] = []
+    for opcode,labels,slots in self.code:
+      bound: list[Operand] = []
+      for kind,opr in slots:
+        if kind == "ph":
+          bound.append(operands[opr])
+        elif kind == "lit":
+          bound.append(opr)
+        elif kind == "tmp":
+          if opr.value not in temps:
+            temps[opr.value] = registers.fresh()
+          bound.append(opr.withValue(temps[opr.value]))
+        else:
+          bound.append(opr.withValue(Program.constant(opr.value, wordSize), OpType.NUMBER))
+      code.append(Instruction(opcode, bound, list(labels)))
+    return Program(code, {}, list(temps.values()), registers)
+
+
+class Output():
+  # A case body as it's written out, split once into literal text and operand
+  # placeholders. Every line is a format string with @A as {0}, @B as {1}, and
+  # so on, text is the whole body as one block of an output file. Operands are
+  # still substituted one after another like str.replace() would when their
+  # text has an @ in it or the body has an @ that isn't a placeholder, as then
+  # one substitution can make the next.
+  __slots__ = ("source", "lines", "text", "exact", "heads", "fields")
+
+  placeholder = re.compile(r"@([A-Z])")
+  unbound = [f"@{chr(65+i)}" for i in range(26)]
+
+  def __init__(self, source: list[str]):
+    self.source = tuple(source)
+    lines = []
+    self.exact = True
+    for line in source:
+      line = line.replace("{", "{{").replace("}", "}}")
+      lines.append(Output.placeholder.sub(lambda m: f"{{{ord(m[1])-65}}}", line))
+      if line.count("@") != len(Output.placeholder.findall(line)):
+        self.exact = False
+    self.lines = tuple(lines)
+    self.text = "\n | ".join(lines)
+    # The first word of every line, which its size is looked up by, and the
+    # operands the line uses
+    self.heads = tuple(line.split()[0] if line.split() else "" for line in source)
+    self.fields = tuple(tuple(sorted(set(ord(c)-65 for c in Output.placeholder.findall(line)))) for line in source)
+
+  def bind(self, texts: list[str]):
+    # What the placeholders become, given the text of each operand. None if
+    # that has to be substituted in turn.
+    if not self.exact:
+      return None
+    for text in texts:
+      if "@" in text:
+        return None
+    return texts + Output.unbound[len(texts):]
+
+  def render(self, texts: list[str]):
+    bound = self.bind(texts)
+    if bound is None:
+      return self.replace(texts)
+    return [line.format(*bound) for line in self.lines]
+
+  def renderText(self, texts: list[str]):
+    bound = self.bind(texts)
+    if bound is None:
+      return "\n | ".join(self.replace(texts))
+    return self.text.format(*bound)
+
+  def replace(self, texts: list[str]):
+    body = list(self.source)
+    for l,line in enumerate(body):
+      for i in range(len(texts)):
+        body[l] = body[l].replace(f"@{chr(65+i)}", texts[i])
+    return body
+
+
+class Sizes():
+  # How many words each line of ISA code takes, from a block in the UTRX file:
+  #   SIZES {
+  #       ADD 1               every line starting with ADD is 1 word
+  #       LDI 1 2 0 255       1 word if the label it uses is at 0 to 255, else 2
+  #       BRA 1 3 ~-128 ~127  1 word if the label is -128 to 127 words away from
+  #                           the line, else 3
+  #       * 1                 any other line
+  #   }
+  # Lines are looked up by their first word as it's written in the case body.
+  __slots__ = ("sizes", "default")
+
+  def __init__(self, sizes: "dict[str, tuple] | None"=None, default: int=1):
+    self.sizes = {} if sizes is None else sizes
+    self.default = default
+
+  def get(self, head: str):
+    # (size,) or (short, long, min, max, relative)
+    spec = self.sizes.get(head)
+    if spec is None:
+      return (self.default,)
+    return spec
+
+  @staticmethod
+  def parse(lines: list[str]):
+    sizes = Sizes()
+    for line,words in Translation.readBlock(lines, "SIZES"):
+      args = words[1:]
+      relative = len(args) == 4 and args[2].startswith("~") and args[3].startswith("~")
+      if relative:
+        args = args[:2] + [args[2][1:], args[3][1:]]
+      try:
+        spec = tuple(int(arg) for arg in args)
+      except ValueError:
+        spec = ()
+      if len(spec) not in [1, 4]:
+        raise ValueError(f"Cannot parse size '{line.strip()}', expected 'NAME size', 'NAME short long min max' or 'NAME short long ~min ~max'.")
+      if words[0] == "*":
+        if len(spec) != 1:
+          raise ValueError(f"Cannot parse size '{line.strip()}', the default size can't depend on labels.")
+        sizes.default = spec[0]
+      elif len(spec) == 1:
+        sizes.sizes[words[0]] = spec
+      else:
+        sizes.sizes[words[0]] = spec + (relative,)
+    return sizes
+
+  @staticmethod
+  def parseFile(filename: str):
+    return Sizes.parse(Translation.readFile(filename))
+
+
+class CPU():
+  # What the target is like, from a block in the UTRX file:
+  #   CPU {
+  #       REGISTERS 8         registers it has, not counting R0
+  #   }
+  __slots__ = ("stats",)
+
+  def __init__(self, stats: "dict[str, int] | None"=None):
+    self.stats = {} if stats is None else stats
+
+  def get(self, name: str, default: "int | None"=None):
+    return self.stats.get(name, default)
+
+  @staticmethod
+  def parse(lines: list[str]):
+    cpu = CPU()
+    for line,words in Translation.readBlock(lines, "CPU"):
+      try:
+        if len(words) != 2:
+          raise ValueError
+        cpu.stats[words[0]] = int(words[1])
+      except ValueError:
+        raise ValueError(f"Cannot parse CPU stat '{line.strip()}', expected 'NAME number'.")
+    return cpu
+
+  @staticmethod
+  def parseFile(filename: str):
+    return CPU.parse(Translation.readFile(filename))
+
+
+class Case():
+  alphabet = "QWERTYUIOPASDFGHJKLZXCVBNM"
+  prefixes = ["!", "$", ">", "<"]
+  infixes = ["==", "~~", "<>", "!=", "!~"]
+  typeClasses = {
+    "A": ["RVSNGZPIMLCO"],
+    "R": ["VSNGZP"],
+    "I": ["MLCZO"],
+    "G": ["VSNP"],
+    "P": ["S"]
+  }
+  types = "ARVSNGZPIMLCO"
+
+  __slots__ = ("params", "string", "code", "language", "patterns", "deferred", "typeOnly", "swaps", "body", "output", "cost", "flat")
+
+  def __init__(self, params: str, body: list[str], language="URCL", cost: "tuple[int, int] | None"=None):
+    self.params = params.split()
+    self.string = params
+    self.code = body
+    self.language = language
+    # (cycles, size) from the header, None if it doesn't say
+    self.cost = cost
+    self.compile()
+    self.output = Output(body)
+    # Bodies that aren't URCL (target ISA code) have no template
+    try:
+      self.body = Body.parse(self.code)
+    except Exception:
+      self.body = None
+    # The body with what it certainly expands to already in it, if the table
+    # has been flattened
+    self.flat: "Body | None" = None
+
+  def compile(self):
+    # Precompute everything matching needs from the parameter string: a Pattern
+    # per operand parameter (None for infix rules), which parameters are left
+    # for a following '<>' to check, and whether the outcome of a match only
+    # depends on operand types and type classes.
+    self.patterns: list["Pattern | None"] = []
+    self.deferred: list[bool] = []
+    self.typeOnly = True
+    self.swaps = "<>" in self.params
+    for p,param in enumerate(self.params):
+      if param in Case.infixes:
+        self.patterns.append(None)
+        self.deferred.append(False)
+        if param in ["==", "!="]:
+          self.typeOnly = False
+        continue
+      pattern = Pattern(param)
+      self.patterns.append(pattern)
+      self.deferred.append(param != self.params[-1] and self.params[p+1] == "<>")
+      if not pattern.typeOnly:
+        self.typeOnly = False
+
+  def matches(self, operands: list["Operand"]):
+    # Returns (matched, swapped). A '<>' rule swaps its operands in place, and
+    # the swap stays even if a later parameter then fails.
+    swapped = False
+    opNum = 0
+    for p,pattern in enumerate(self.patterns):
+      if pattern is None:
+        param = self.params[p]
+        op1 = operands[opNum]
+        op2 = operands[(opNum + 1) % len(operands)]
+        if param == "==" and (op1.value != op2.value or  op1.type != op2.type) \
+        or param == "!=" and (op1.value == op2.value and op1.type == op2.type) \
+        or param == "~~" and (op1.type != op2.type) \
+        or param == "!~" and (op1.type == op2.type):
+          return False, swapped
+        if param == "<>":
+          before = self.patterns[p-1]
+          after = self.patterns[(p+1) % len(self.patterns)]
+          if not (Case.matchParam(op1, before, self.params[p-1]) and Case.matchParam(op2, after, self.params[(p+1) % len(self.params)])):
+            if (Case.matchParam(op2, before, self.params[p-1]) and Case.matchParam(op1, after, self.params[(p+1) % len(self.params)])):
+              operands[opNum] = op2
+              operands[(opNum+1)%len(operands)] = op1
+              swapped = True
+            else:
+              return False, swapped
+          opNum += 1
+          continue
+      else:
+        if self.deferred[p]:
+          continue
+        if not pattern.match(operands[opNum]):
+          return False, swapped
+        opNum += 1
+    return True, swapped
+
+  @staticmethod
+  def matchParam(operand: "Operand", pattern: "Pattern | None", param: str):
+    # Infix rules on either side of '<>' get matched as patterns, as they were
+    # before compiling
+    if pattern is None:
+      pattern = Pattern(param)
+    return pattern.match(operand)
+
+  @staticmethod
+  def match(operand: "Operand", param: str):
+    return Pattern(param).match(operand)
 
 
 class Translation():
-  def __init__(self, opcode: str, language="URCL", description:list[str]=[], cases:list[Case]=[]):
+  __slots__ = ("opcode", "description", "cases", "language", "index")
+
+  def __init__(self, opcode: str, language="URCL", description:"list[str] | None"=None, cases:"list[Case] | None"=None):
     self.opcode = opcode
-    self.description = description
-    self.cases = cases
+    self.description = [] if description is None else description
+    self.cases = [] if cases is None else cases
     self.language = language
+    # Maps the (type, typeClass) of each operand to (first case worth trying,
+    # whether that case is known to match)
+    self.index: dict[tuple, tuple[int, bool]] = {}
 
   def toString(self):
     m = max(map(lambda a: len(a), self.description)) + 4
@@ -109,7 +426,7 @@ class Translation():
           lang = " ".join(line.split()[2:])
         else:
           lang = "URCL"
-        translation = copy.deepcopy(Translation(line.split()[1], lang))
+        translation = Translation(line.split()[1], lang)
         desc = True
         unparsed[l] = None
         continue
@@ -122,7 +439,7 @@ class Translation():
         unparsed[l] = None
       elif " :: " in line and line[-1] == "{":
         if translations.get(line.split(" :: ")[0]) is None:
-          translations[line.split(" :: ")[0]] = copy.deepcopy(Translation(line.split(" :: ")[0], "URCL", "This instruction is undocumented. :("))
+          translations[line.split(" :: ")[0]] = Translation(line.split(" :: ")[0], "URCL", ["This instruction is undocumented. :("])
     unparsed = list(filter(None, unparsed))
     return translations, unparsed
 
@@ -134,6 +451,21 @@ class Translation():
         lines.append(line.rstrip("\n"))
     return lines
 
+  @staticmethod
+  def readBlock(lines: list[str], name: str):
+    # (line, words) for every line of a 'NAME {' block that isn't empty
+    inside = False
+    for line in lines:
+      words = line.split()
+      if not inside:
+        inside = words == [name, "{"]
+        continue
+      if words == ["}"]:
+        inside = False
+        continue
+      if words:
+        yield line, words
+
   @staticmethod
   def readCases(translations: dict[str, "Translation"], unparsed: str):
     body: list[str] = []
@@ -142,8 +474,8 @@ class Translation():
     for line in unparsed:
       if opcode:
         if line == "}":
-          newcase = Case(params, body, translations[opcode].language)
-          translations[opcode].cases.append(copy.deepcopy(newcase))
+          newcase = Case(params, body, translations[opcode].language, cost)
+          translations[opcode].cases.append(newcase)
           opcode = ""
           body = []
         else:
@@ -154,8 +486,23 @@ class Translation():
           params = ""
         else:
           params = params.rstrip("{")
+        params, cost = Translation.parseCost(line, params)
     return translations
 
+  @staticmethod
+  def parseCost(line: str, params: str):
+    # A case can end its header in '| cycles size', what it costs to run
+    if "|" not in params:
+      return params, None
+    params, cost = params.split("|", 1)
+    try:
+      cost = tuple(int(word) for word in cost.split())
+    except ValueError:
+      cost = ()
+    if len(cost) != 2:
+      raise ValueError(f"Cannot parse cost of '{line.strip()}', expected '| cycles size'.")
+    return params, cost
+
   @staticmethod
   def parseFile(filename):
     unparsed = Translation.readFile(filename)
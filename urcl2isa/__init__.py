@@ -3,4 +3,19 @@ import urcl2isa.isa
 import urcl2isa.instruction
 import urcl2isa.program
 import urcl2isa.translator
-import urcl2isa.UTRX
\ No newline at end of file
+import urcl2isa.UTRX
+import urcl2isa.cache
+import urcl2isa.stream
+import urcl2isa.batch
+import urcl2isa.profiler
+import urcl2isa.incremental
+import urcl2isa.addresses
+import urcl2isa.peephole
+import urcl2isa.selector
+import urcl2isa.allocator
+import urcl2isa.flatten
+import urcl2isa.server
+import urcl2isa.folding
+import urcl2isa.fanout
+import urcl2isa.lowered
+import urcl2isa.simulator
\ No newline at end of file
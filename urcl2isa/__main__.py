@@ -1,18 +1,50 @@
 def main():
     from program import Program
     from translator import Translator
+    from stream import Stream
+    from batch import Batch
+    from profiler import Profiler
+    from incremental import Incremental
     from isa import Block
+    from addresses import Addresses
+    from peephole import Peephole
+    from selector import Selector
+    from allocator import Allocator
+    from server import Server
+    from folding import Folder
+    from fanout import FanOut
+    from lowered import CoreCache
+    from simulator import Simulator
+    import os
+    import time
+    import sys
     import colorama
     from timeit import default_timer as timer
     import argparse
 
     p = argparse.ArgumentParser()
     p.add_argument("-f", "--File", help="URCL file to be translated")
-    p.add_argument("-t", "--Target", help="UTRX file containing translations")
-    p.add_argument("-o", "--Output", help="File to store output in")
+    p.add_argument("-t", "--Target", help="UTRX files containing translations, one output file for each if there's more than one", nargs="+")
+    p.add_argument("-o", "--Output", help="File to store output in, or the folder to store outputs in with several targets or --Batch")
     p.add_argument("-s", "--Silent", help="Hide terminal output")
     p.add_argument("-b", "--Boring", help="Give uncoloured output")
     p.add_argument("-w", "--WordSize", help="The size of a word")
+    p.add_argument("-c", "--CacheSize", help="How many URCL expansions to cache, 0 to disable")
+    p.add_argument("-r", "--Reparse", help="Parse UTRX files even if compiled tables are cached")
+    p.add_argument("-S", "--Stream", help="Translate in one pass straight to the output, for very large programs")
+    p.add_argument("-j", "--Jobs", help="How many processes translate to the ISA")
+    p.add_argument("-B", "--Batch", help="Glob, directory or manifest of URCL files to translate, -o is then a folder")
+    p.add_argument("-p", "--Profile", help="File to write stage times and match statistics to as JSON, - for the terminal")
+    p.add_argument("-i", "--Incremental", help="Reuse cached results from earlier translations of the file")
+    p.add_argument("-W", "--Watch", help="Translate the file incrementally again whenever it changes")
+    p.add_argument("-a", "--Addresses", help="Replace labels with addresses, using the sizes in the target file")
+    p.add_argument("-P", "--Peephole", help="File of peephole rules to optimise the core URCL with")
+    p.add_argument("-R", "--Allocate", help="Reuse registers once what they hold is dead, within the target's register count")
+    p.add_argument("-O", "--Optimize", "--optimize", help="Keep instructions the target does cheaper than their expansion, by cost in cycles or words", choices=Selector.goals)
+    p.add_argument("-F", "--Fold", help="Fold constants and remove unreachable code before expanding")
+    p.add_argument("-C", "--Core", help="Keep lowered core URCL in a cache, and reuse it while the source, tables and options are the same")
+    p.add_argument("-X", "--Simulate", help="Run the core URCL for at most this many instructions, counting what ran and its cycles on the target")
+    p.add_argument("-L", "--Listen", help="Serve translation requests as JSON lines on a Unix socket, or - for stdin/stdout")
 
     argv = p.parse_args()
 
@@ -20,65 +52,318 @@ def main():
     filename = "mycode.urcl"
     if argv.File:
         filename = argv.File
-    ISAtranslations = "core.utrx"
+    targets = ["core.utrx"]
     if argv.Target:
-        ISAtranslations = argv.Target
+        targets = argv.Target
+    ISAtranslations = targets[0]
+    if len(targets) > 1:
+        # Only plain translation shares the core URCL between targets
+        for flag in ["Batch", "Incremental", "Watch", "Stream", "Listen", "Optimize"]:
+            if getattr(argv, flag):
+                p.error(f"--{flag} takes one target")
+    if (len(targets) > 1 or argv.Batch) and argv.Output and os.path.exists(argv.Output) and not os.path.isdir(argv.Output):
+        p.error(f"--Output is a folder with several targets or --Batch, and '{argv.Output}' is a file")
     wordSize = 8
     if argv.WordSize:
         wordSize = int(argv.WordSize)
+    cacheSize = 4096
+    if argv.CacheSize:
+        cacheSize = int(argv.CacheSize)
+    jobs = 1
+    if argv.Jobs:
+        jobs = int(argv.Jobs)
 
     URCLtranslations = "urcl2isa/urcl.utrx"
 
+    def load(select: bool=True):
+        # Translating an instruction at a time there's no telling what relative
+        # jumps around it reach, so those modes can't select
+        translator = Translator.fromFile(URCLtranslations, cacheSize, not argv.Reparse, flat=True)
+        translatorISA = Translator.fromFile(ISAtranslations, cached=not argv.Reparse)
+        if not argv.Silent:
+            for cycle in translator.cycles:
+                print(f"Warning: {URCLtranslations}: {cycle} never stops expanding")
+        if argv.Optimize and select:
+            translator.selector = Selector(translator, translatorISA, argv.Optimize)
+        return translator, translatorISA
+
+    def writeProfile(report: str):
+        if argv.Profile == "-":
+            print(report)
+        else:
+            with open(argv.Profile, "w+") as f:
+                f.write(report + "\n")
+
     start = timer()
 
-    main = Program.parseFile(filename)
-    translator = Translator.fromFile(URCLtranslations)
-    translatorISA = Translator.fromFile(ISAtranslations)
-
-    def translate(program: Program, trans: Translator):
-        done = False
-        while not done:
-            done = True
-            for l,ins in enumerate(program.code):
-                sub = trans.substituteURCL(ins)
-                if sub != "":
-                    while len(set(sub.regs + program.regs)) != len(sub.regs + program.regs):
-                        sub.primeRegs()
-                    sub.unpackPlaceholders()
-                    sub = translate(sub, trans)
-                    program.insertSub(sub, l)
-                    done = False
+    if argv.Listen:
+        server = Server(URCLtranslations, ISAtranslations if argv.Target else None, cacheSize, not argv.Reparse)
+        try:
+            server.run(argv.Listen)
+        except KeyboardInterrupt:
+            pass
+        except ValueError as e:
+            p.error(str(e))
+        if not argv.Silent:
+            # stdout may be carrying replies
+            print(server.toString(), file=sys.stderr)
+        return
+
+    if argv.Batch:
+        translator, translatorISA = load()
+        batch = Batch(translator, translatorISA, ISAtranslations, argv.Output, jobs)
+        for filename,output,read,written,error in batch.run(Batch.collect(argv.Batch)):
+            if error is not None:
+                print(f"{filename}: {error}")
+            elif not argv.Silent:
+                print(f"{filename} -> {output}: {read} instructions, {written} core instructions")
+        if not argv.Silent:
+            print(f"-"*30)
+            print(batch.toString())
+            print(f"-"*30)
+        return
+
+    if argv.Incremental or argv.Watch:
+        translator, translatorISA = load(False)
+        incremental = Incremental(translator, translatorISA, [URCLtranslations, ISAtranslations])
+        path = Incremental.cachePath(filename, ISAtranslations)
+        incremental.load(path)
+        seen = None
+        try:
+            while True:
+                stat = os.stat(filename)
+                if (stat.st_mtime_ns, stat.st_size) != seen:
+                    seen = (stat.st_mtime_ns, stat.st_size)
+                    start = timer()
+                    with open(filename, "r") as f:
+                        lines = f.read().splitlines()
+                    try:
+                        out = incremental.run(lines)
+                    except Exception as e:
+                        # Half done, so the next run starts over
+                        incremental.reset()
+                        if not argv.Watch:
+                            raise
+                        print(f"{filename}: {type(e).__name__}: {e}")
+                    else:
+                        if argv.Output:
+                            with open(argv.Output, "w+") as f:
+                                Block.write(out, f)
+                        elif not argv.Silent:
+                            for block in out:
+                                block.print(indent=20)
+                        incremental.save(path)
+                        end = timer()
+                        if not argv.Silent:
+                            print(f"-"*30)
+                            print(f"{filename} translated to {ISAtranslations} in {end-start:.10f} seconds.")
+                            print(incremental.toString())
+                            print(f"Registers used: {incremental.numbering.count}")
+                            print(f"-"*30)
+                if not argv.Watch:
                     break
-        return program
+                time.sleep(0.25)
+        except KeyboardInterrupt:
+            pass
+        return
 
-    def translateISA(program: Program, trans: Translator):
-        out: list[Block] = []
-        for l,ins in enumerate(program.code):
-            out.append(Block(ins.labels, trans.substitute(ins)))
-        return out
+    if argv.Stream:
+        translator, translatorISA = load(False)
+        stream = Stream(translator, translatorISA)
+        with open(filename, "r") as f:
+            if argv.Output:
+                with open(argv.Output, "w+", buffering=Stream.bufferSize) as out:
+                    stream.run(f, out)
+            else:
+                stream.run(f, sys.stdout)
+        end = timer()
+        if not argv.Silent:
+            print(f"-"*30)
+            print(f"{filename} streamed to {ISAtranslations}:")
+            print(f"{stream.read} instructions in, {stream.written} blocks out.")
+            print(f"In {end-start:.10f} seconds.")
+            print(f"Registers used: {stream.numbering.count}")
+            print(f"Expansion cache: {translator.cache.toString()}")
+            print(f"-"*30)
+        return
 
-    main = translate(main, translator)
+    coreCache = None
+    main = None
+    if argv.Core:
+        # Lowering only depends on these, and on the targets through -O and -R
+        coreCache = CoreCache.forFile(filename)
+        files = [filename, URCLtranslations]
+        if argv.Peephole:
+            files.append(argv.Peephole)
+        if argv.Optimize or argv.Allocate:
+            files += targets
+        with open(filename, "r") as f:
+            fileWordSize = Program.wordSize(Program.parseHeaders(f), wordSize)
+        options = [f"tables v{Translator.tableVersion}", f"word size {fileWordSize}", f"fold {bool(argv.Fold)}",
+                   f"optimize {argv.Optimize}", f"allocate {bool(argv.Allocate)}"]
+        key = CoreCache.key(files, options)
+        main = coreCache.get(key)
 
-    main.makeRegsNumeric()
-    main.relativesToLabels()
+    if main is not None:
+        loaded = timer()
+        translatorsISA = {target: Translator.fromFile(target, cached=not argv.Reparse) for target in targets}
+        translatorISA = translatorsISA[ISAtranslations]
+        profiler = None
+        if argv.Profile:
+            profiler = Profiler()
+            for target,translatorTarget in translatorsISA.items():
+                translatorTarget.stats = profiler.table(target)
+            profiler.stage("core cache", loaded - start)
+        if not argv.Silent:
+            print(f"-"*30)
+            print(f"{filename} was lowered to core URCL by an earlier run, {len(main.code)} core instructions loaded.")
+            print(f"In {loaded-start:.10f} seconds.")
+            print(f"-"*30)
+    else:
+        main = Program.parseFile(filename)
+        parsed = timer()
+        translator, translatorISA = load()
+        translatorsISA = {ISAtranslations: translatorISA}
+        for target in targets[1:]:
+            translatorsISA[target] = Translator.fromFile(target, cached=not argv.Reparse)
+        loaded = timer()
+        profiler = None
+        if argv.Profile:
+            profiler = Profiler()
+            translator.stats = profiler.table(URCLtranslations)
+            translator.stats.cache = translator.cache
+            for target,translatorTarget in translatorsISA.items():
+                translatorTarget.stats = profiler.table(target)
+            sizes = [len(main.code)]
+        folder = None
+        if argv.Fold:
+            # Folding is exact, so it's in the program's own word size
+            folder = Folder(Program.wordSize(main.headers, wordSize))
+            folder.run(main)
+        folded = timer()
+        if profiler is not None:
+            sizes.append(len(main.code))
+        if translator.selector is not None:
+            translator.selector.estimate(main.code)
 
-    end = timer()
+        main = translator.translate(main)
+        expanded = timer()
+        if profiler is not None:
+            sizes.append(len(main.code))
 
-    if not argv.Silent:
-        print(f"-"*30)
-        print(f"{filename} translated to {URCLtranslations}:")
-        print(f"-"*30)
-        if argv.Boring:
-            print(main.toString(indent=20))
-        else:
-            print(main.toColour(indent=20))
-        print(f"-"*30)
-        print(f"In {end-start:.10f} seconds.")
-        print(f"Registers used: {len(main.regs)}")
-        print(f"-"*30)
+        allocator = None
+        if argv.Allocate:
+            # The core URCL has to fit every target
+            limits = [t.cpu.get("REGISTERS") for t in translatorsISA.values() if t.cpu.get("REGISTERS") is not None]
+            allocator = Allocator(min(limits) if limits else None)
+            allocator.run(main)
+        allocated = timer()
+
+        main.makeRegsNumeric()
+        numbered = timer()
+        main.relativesToLabels()
+        converted = timer()
+
+        peephole = None
+        if argv.Peephole:
+            peephole = Peephole.parseFile(argv.Peephole)
+            peephole.run(main)
+
+        end = timer()
+
+        if profiler is not None:
+            with open(filename, "r") as f:
+                lines = sum(1 for line in f)
+            profiler.stage("parse", parsed - start, lines, sizes[0])
+            profiler.stage("table loading", loaded - parsed)
+            if folder is not None:
+                profiler.stage("constant folding", folded - loaded, sizes[0], sizes[1])
+            profiler.stage("expansion", expanded - folded, sizes[1], sizes[2])
+            if allocator is not None:
+                profiler.stage("register allocation", allocated - expanded, sizes[2], len(main.code))
+            profiler.stage("register numbering", numbered - allocated, len(main.code), len(main.code))
+            profiler.stage("label conversion", converted - numbered, len(main.code), len(main.code))
+            if peephole is not None:
+                profiler.stage("peephole", end - converted, peephole.before, peephole.after)
+
+        if not argv.Silent:
+            print(f"-"*30)
+            print(f"{filename} translated to {URCLtranslations}:")
+            print(f"-"*30)
+            if argv.Boring:
+                print(main.toString(indent=20))
+            else:
+                print(main.toColour(indent=20))
+            print(f"-"*30)
+            print(f"In {end-start:.10f} seconds.")
+            print(f"Registers used: {len(main.regs)}")
+            print(f"Expansion cache: {translator.cache.toString()}")
+            if folder is not None:
+                print(folder.toString())
+            if translator.selector is not None:
+                print(translator.selector.toString())
+            if allocator is not None:
+                print(allocator.toString())
+            if peephole is not None:
+                print(peephole.toString())
+            saved = translator.savedTime + translatorISA.savedTime
+            if saved:
+                print(f"Cached UTRX tables saved {saved:.10f} seconds of startup.")
+            print(f"-"*30)
+
+
+        if coreCache is not None:
+            coreCache.put(key, main)
+
+    if argv.Simulate:
+        try:
+            simulator = Simulator(main, wordSize)
+        except ValueError as e:
+            # Only measures the code, it's still written out
+            simulator = None
+            print(f"{filename} can't be simulated: {e}")
+        if simulator is not None:
+            simulator.cost(translatorISA)
+            simulator.run(int(argv.Simulate))
+            if not argv.Silent:
+                print(f"-"*30)
+                print(simulator.toString())
+                print(f"-"*30)
+            if profiler is not None:
+                profiler.stage("simulation", simulator.time)
 
     start = timer()
-    out = translateISA(main, translatorISA)
+    if len(targets) > 1:
+        # Match statistics are only kept by translators in this process
+        fanJobs = 1 if profiler is not None else jobs if argv.Jobs else len(targets)
+        fanout = FanOut(translatorsISA, argv.Output, fanJobs, wordSize if argv.Addresses else None)
+        for target,output,words,error in fanout.run(main, filename):
+            if error is not None:
+                print(f"{target}: {error}")
+            elif not argv.Silent:
+                size = "" if words is None else f", {words} words of code"
+                print(f"{filename} translated to {target} -> {output}{size}")
+        end = timer()
+        if not argv.Silent:
+            print(f"-"*30)
+            print(fanout.toString())
+            print(f"-"*30)
+        if profiler is not None:
+            profiler.stage("ISA emission", end - start, len(main.code), len(main.code) * len(targets))
+            writeProfile(profiler.toJSON(file=filename, targets=targets))
+        return
+
+    addresses = None
+    if argv.Addresses:
+        addresses = Addresses(translatorISA, wordSize)
+        out = addresses.resolve(main)
+    elif argv.Silent and argv.Output and profiler is None and jobs <= 1:
+        # Nothing to show, so the code goes straight to the file
+        with open(argv.Output, "w+") as f:
+            translatorISA.writeISA(main, f)
+        return
+    else:
+        out = translatorISA.translateISA(main, jobs)
     end = timer()
 
     if not argv.Silent:
@@ -89,12 +374,17 @@ def main():
             block.print(indent=20)
         print(f"-"*30)
         print(f"In {end-start:.10f} seconds.")
+        if addresses is not None:
+            print(addresses.toString())
         print(f"-"*30)
 
     if argv.Output:
         with open(argv.Output, "w+") as f:
-            for block in out:
-                f.write(block.toString() + "\n")
+            Block.write(out, f)
+
+    if profiler is not None:
+        profiler.stage("ISA emission", end - start, len(main.code), sum(len(block.code) for block in out))
+        writeProfile(profiler.toJSON(file=filename, target=ISAtranslations))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
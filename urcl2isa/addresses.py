@@ -0,0 +1,155 @@
+from itertools import accumulate
+from operand import Operand, OpType
+from program import Program
+from translator import Translator
+from isa import Block
+
+class Lengths():
+    # Sizes of lines of code as a Fenwick tree: the address of any line, and
+    # making one line longer, both take O(log n) instead of adding every size
+    # before the line up again
+    __slots__ = ("tree",)
+
+    def __init__(self, sizes: list[int]):
+        tree = [0] + sizes
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def add(self, line: int, size: int):
+        i = line + 1
+        while i < len(self.tree):
+            self.tree[i] += size
+            i += i & -i
+
+    def before(self, line: int):
+        # Total size of every line before this one
+        total = 0
+        i = line
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+class Addresses():
+    # Translates to ISA code with labels replaced by absolute addresses, for
+    # targets with instructions of different sizes. Sizes come from the SIZES
+    # block of the target's UTRX file. One pass matches every instruction,
+    # sizes its lines and indexes the labels, a second one patches operands.
+    # Lines whose size depends on where their label is, or how far away it is,
+    # start short, and only those get checked again after some of them had to
+    # grow, until none has to. Lines only ever grow, so that always ends.
+    def __init__(self, translator: Translator, wordSize: int=8):
+        self.translator = translator
+        self.wordSize = wordSize
+        # What the last run did
+        self.labels = 0
+        self.rounds = 0
+        self.grown = 0
+        self.size = 0
+
+    def resolve(self, program: Program):
+        translator = self.translator
+        sizes = translator.sizes
+        names: dict[Operand, str] = {}
+        matched: list[tuple] = []
+        labels: dict[str, int] = {}
+        lines: list[int] = []
+        # (line, (short, long, min, max, relative), operands with labels)
+        relaxing: list[tuple] = []
+        for ins in program.code:
+            for label in ins.labels:
+                labels.setdefault(label.lstrip("."), len(lines))
+            case = translator.case(ins)
+            matched.append((case, Translator.texts(ins, names)))
+            if case is None:
+                continue
+            output = case.output
+            for head,fields in zip(output.heads, output.fields):
+                spec = sizes.get(head)
+                if len(spec) == 1:
+                    lines.append(spec[0])
+                    continue
+                used = [ins.operands[o] for o in fields if o < len(ins.operands)]
+                refs = [opr for opr in used if opr.type == OpType.LABEL]
+                numbers = [opr for opr in used if opr.type == OpType.NUMBER]
+                if refs:
+                    relaxing.append((len(lines), spec, refs))
+                    lines.append(spec[0])
+                elif numbers and not spec[4]:
+                    # Numbers are where they are from the start
+                    lines.append(spec[0] if all(Addresses.fits(opr, spec) for opr in numbers) else spec[1])
+                else:
+                    # Nothing to measure, so it can't be short
+                    lines.append(spec[1])
+        self.labels = len(labels)
+
+        lengths = Lengths(lines)
+        self.rounds = 0
+        self.grown = 0
+        while relaxing:
+            self.rounds += 1
+            short: list[tuple] = []
+            for line,spec,refs in relaxing:
+                at = lengths.before(line) if spec[4] else 0
+                for opr in refs:
+                    target = labels.get(Addresses.name(opr))
+                    # Labels that aren't anywhere can't be short either
+                    if target is not None:
+                        address = lengths.before(target)
+                        value = address - at if spec[4] else self.address(opr, address)
+                    if target is None or not spec[2] <= value <= spec[3]:
+                        lengths.add(line, spec[1] - spec[0])
+                        lines[line] = spec[1]
+                        self.grown += 1
+                        break
+                else:
+                    short.append((line, spec, refs))
+            if len(short) == len(relaxing):
+                break
+            relaxing = short
+        # Settled, so every address can be added up once
+        addresses = list(accumulate(lines, initial=0))
+        self.size = addresses[-1]
+
+        out: list[Block] = []
+        for ins,(case,texts) in zip(program.code, matched):
+            if case is None:
+                out.append(Block(ins.labels, ""))
+                continue
+            patched = texts
+            for o,opr in enumerate(ins.operands):
+                if opr.type != OpType.LABEL:
+                    continue
+                target = labels.get(Addresses.name(opr))
+                if target is None:
+                    continue
+                if patched is texts:
+                    patched = list(texts)
+                patched[o] = str(self.address(opr, addresses[target]))
+            out.append(Block(ins.labels, case.output.render(patched)))
+        return out
+
+    @staticmethod
+    def fits(number: Operand, spec: tuple):
+        try:
+            return spec[2] <= int(number.value) <= spec[3]
+        except ValueError:
+            return False
+
+    @staticmethod
+    def name(label: Operand):
+        return label.value.split("[")[0]
+
+    def address(self, label: Operand, address: int):
+        # Multi-word operands like .data[1] are one word of the address, word 0
+        # being the lowest
+        if "[" not in label.value:
+            return address
+        return (address >> (label.word * self.wordSize)) & ((1 << self.wordSize) - 1)
+
+    def toString(self):
+        return f"{self.labels} labels at addresses, {self.size} words of code, {self.grown} lines lengthened over {self.rounds} rounds"
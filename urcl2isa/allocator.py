@@ -0,0 +1,317 @@
+from heapq import heappush, heappop, heapify
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Header
+
+class Allocator():
+    # Gives registers numbers by liveness, so registers that are never live at
+    # the same time share one. Runs on expanded core URCL before the registers
+    # are numbered. Control flows through labels and BGE, and registers live
+    # from block to block are found by dataflow over that. Every register gets
+    # the interval from the first to the last point it's live at, which a
+    # linear scan hands numbers out to. With a limit on the number of
+    # registers, the ones that would go over it and are live the longest live
+    # in memory just past the heap instead, loaded into fresh registers before
+    # every use and stored after every write, and the scan starts over until
+    # everything fits.
+    # Instructions it doesn't know might jump anywhere there's a label, read
+    # every register they have, and write the first.
+    writers = {"ADD", "NOR", "IMM", "RSH", "LOD", "IN"}
+    readers = {"STR", "BGE", "OUT", "NOP"}
+
+    def __init__(self, limit: "int | None"=None, heap: int=16):
+        # No limit takes MINREG from the program, as targets running it have at
+        # least that many registers, or else as many as it takes
+        self.limit = limit
+        # Where spilled registers go if the program doesn't say MINHEAP
+        self.heap = heap
+        # What the last run did
+        self.virtual = 0
+        self.allocated = 0
+        self.spilled = 0
+        self.rounds = 0
+        self.budget: "int | None" = None
+
+    def run(self, program: Program):
+        # Spill code would move what relative jumps reach
+        program.relativesToLabels()
+        limit = self.limit
+        if limit is None and Header.MINREG.value in program.headers:
+            limit = int(program.headers[Header.MINREG.value][0])
+        self.budget = limit
+        heap = self.heap
+        if Header.MINHEAP.value in program.headers:
+            heap = int(program.headers[Header.MINHEAP.value][0])
+        # Registers of spill code, which can't be spilled themselves
+        fixed: set[int] = set()
+        slots: dict[int, int] = {}
+        self.virtual = len(set(opr.value for ins in program.code for opr in ins.operands
+                               if opr.type == OpType.REGISTER and opr.value != 0))
+        self.rounds = 0
+        while True:
+            self.rounds += 1
+            roles = [Allocator.roles(ins) for ins in program.code]
+            intervals = self.intervals(program.code, roles)
+            numbers, spills = self.scan(intervals, limit, fixed)
+            if not spills:
+                break
+            for reg in spills:
+                slots[reg] = len(slots)
+            program.code = self.spill(program, roles, spills, slots, heap, fixed)
+        self.spilled = len(slots)
+        if slots:
+            program.headers[Header.MINHEAP.value] = [str(heap + len(slots))]
+
+        renamed: dict[tuple, Operand] = {}
+        for ins in program.code:
+            for o,opr in enumerate(ins.operands):
+                if opr.type != OpType.REGISTER or opr.value == 0:
+                    continue
+                key = (opr.value, opr.word, opr.typeClass)
+                new = renamed.get(key)
+                if new is None:
+                    new = opr.withValue(numbers[opr.value])
+                    renamed[key] = new
+                ins.operands[o] = new
+        self.allocated = len(set(numbers.values()))
+        program.headers[Header.MINREG.value] = [str(self.allocated)]
+        return program
+
+    @staticmethod
+    def roles(ins: Instruction):
+        # (registers read, registers written), leaving out R0
+        regs = tuple([opr.value for opr in ins.operands if opr.type == OpType.REGISTER and opr.value != 0])
+        if not regs:
+            return regs, regs
+        first = ins.operands[0]
+        writes = first.type == OpType.REGISTER and first.value != 0
+        if ins.opcode in Allocator.writers:
+            if not writes:
+                return regs, ()
+            return regs[1:], (first.value,)
+        if ins.opcode in Allocator.readers or not writes:
+            return regs, ()
+        return regs, (first.value,)
+
+    def intervals(self, code: list[Instruction], roles: list[tuple]):
+        # (start, end, register) for every register. Instruction i reads at
+        # point 2i and writes at 2i+1, so what it reads last can share a
+        # number with what it writes.
+        n = len(code)
+        labels: dict[str, int] = {}
+        for i,ins in enumerate(code):
+            for label in ins.labels:
+                labels.setdefault(label.lstrip("."), i)
+        # Registers only ever written by 'IMM reg .label' hold that label
+        writes: dict[int, int] = {}
+        for _,defs in roles:
+            for reg in defs:
+                writes[reg] = writes.get(reg, 0) + 1
+        holds: dict[int, str] = {}
+        for ins,(_,defs) in zip(code, roles):
+            if ins.opcode == "IMM" and defs and writes[defs[0]] == 1 and ins.operands[1].type == OpType.LABEL:
+                holds[defs[0]] = ins.operands[1].value
+
+        # Blocks start at labels and after jumps
+        starts = {0} if n else set()
+        for i,ins in enumerate(code):
+            if ins.labels:
+                starts.add(i)
+            if ins.opcode not in Allocator.writers and ins.opcode not in Allocator.readers or ins.opcode == "BGE":
+                if i + 1 < n:
+                    starts.add(i + 1)
+        starts = sorted(starts)
+        ends = [s - 1 for s in starts[1:]] + [n - 1]
+        block = {s: b for b,s in enumerate(starts)}
+        # A jump to somewhere not known goes through one more block, that leads
+        # to every label and the start
+        anywhere = len(starts)
+        succs: list[list[int]] = []
+        for b,end in enumerate(ends):
+            ins = code[end]
+            succ = []
+            if end + 1 < n:
+                succ.append(b + 1)
+            if ins.opcode == "BGE" and ins.operands:
+                target = ins.operands[0]
+                name = target.value if target.type == OpType.LABEL else holds.get(target.value) if target.type == OpType.REGISTER else None
+                if name is not None and name.split("[")[0] in labels:
+                    succ.append(block[labels[name.split("[")[0]]])
+                else:
+                    succ.append(anywhere)
+            elif ins.opcode not in Allocator.writers and ins.opcode not in Allocator.readers:
+                for opr in ins.operands:
+                    if opr.type == OpType.LABEL and opr.value.split("[")[0] in labels:
+                        succ.append(block[labels[opr.value.split("[")[0]]])
+                succ.append(anywhere)
+            succs.append(succ)
+        succs.append(sorted({0} | {block[i] for i in labels.values()}) if n else [])
+        preds: list[list[int]] = [[] for _ in succs]
+        for b,succ in enumerate(succs):
+            for s in succ:
+                preds[s].append(b)
+
+        # Registers read in some block before they're written there are the
+        # only ones that can be live from one block to another
+        gen: list[set] = []
+        kill: list[set] = []
+        for b,start in enumerate(starts):
+            used: set[int] = set()
+            written: set[int] = set()
+            for i in range(start, ends[b] + 1):
+                uses, defs = roles[i]
+                for reg in uses:
+                    if reg not in written:
+                        used.add(reg)
+                for reg in defs:
+                    # Writes of instructions that might not write don't count
+                    if code[i].opcode in Allocator.writers:
+                        written.add(reg)
+            gen.append(used)
+            kill.append(written)
+        bits: dict[int, int] = {}
+        for used in gen:
+            for reg in used:
+                if reg not in bits:
+                    bits[reg] = len(bits)
+        regs = list(bits)
+        genMask = [Allocator.mask(used, bits) for used in gen] + [0]
+        killMask = [Allocator.mask(written, bits) for written in kill] + [0]
+        liveIn = [0] * len(succs)
+        liveOut = [0] * len(succs)
+        work = list(range(len(succs)))
+        queued = [True] * len(succs)
+        while work:
+            b = work.pop()
+            queued[b] = False
+            out = 0
+            for s in succs[b]:
+                out |= liveIn[s]
+            liveOut[b] = out
+            live = genMask[b] | (out & ~killMask[b])
+            if live != liveIn[b]:
+                liveIn[b] = live
+                for p in preds[b]:
+                    if not queued[p]:
+                        queued[p] = True
+                        work.append(p)
+
+        first: dict[int, int] = {}
+        last: dict[int, int] = {}
+        def extend(reg: int, point: int):
+            if reg in first:
+                if point < first[reg]:
+                    first[reg] = point
+                elif point > last[reg]:
+                    last[reg] = point
+            else:
+                first[reg] = last[reg] = point
+        for b,start in enumerate(starts):
+            for reg in Allocator.members(liveIn[b], regs):
+                extend(reg, 2*start)
+            for reg in Allocator.members(liveOut[b], regs):
+                extend(reg, 2*ends[b] + 1)
+        for i,(uses,defs) in enumerate(roles):
+            for reg in uses:
+                extend(reg, 2*i)
+            for reg in defs:
+                extend(reg, 2*i + 1)
+        return sorted((first[reg], last[reg], reg) for reg in first)
+
+    @staticmethod
+    def mask(regs: set, bits: dict[int, int]):
+        # Registers without a bit are never live across blocks
+        mask = 0
+        for reg in regs:
+            bit = bits.get(reg)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    @staticmethod
+    def members(mask: int, regs: list[int]):
+        while mask:
+            low = mask & -mask
+            yield regs[low.bit_length() - 1]
+            mask ^= low
+
+    def scan(self, intervals: list[tuple], limit: "int | None", fixed: set[int]):
+        # Numbers for every register, and the registers to spill if it didn't
+        # fit in limit
+        numbers: dict[int, int] = {}
+        spills: list[int] = []
+        free: list[int] = []
+        count = 0
+        active: list[tuple[int, int]] = []
+        for start,end,reg in intervals:
+            while active and active[0][0] < start:
+                heappush(free, numbers[heappop(active)[1]])
+            if free:
+                numbers[reg] = heappop(free)
+            elif limit is None or count < limit:
+                count += 1
+                numbers[reg] = count
+            else:
+                # The one that's live the longest goes
+                victim = None
+                if reg not in fixed:
+                    victim = (end, reg)
+                for other in active:
+                    if other[1] not in fixed and (victim is None or other[0] > victim[0]):
+                        victim = other
+                if victim is None:
+                    raise ValueError(f"Cannot fit the code in {limit} registers, it needs more than that at once.")
+                spills.append(victim[1])
+                if victim[1] == reg:
+                    continue
+                active.remove(victim)
+                heapify(active)
+                numbers[reg] = numbers.pop(victim[1])
+            heappush(active, (end, reg))
+        return numbers, spills
+
+    def spill(self, program: Program, roles: list[tuple], spills: list[int], slots: dict[int, int], heap: int, fixed: set[int]):
+        # The code with every spilled register in memory
+        spilled = set(spills)
+        code: list[Instruction] = []
+        for ins,(uses,defs) in zip(program.code, roles):
+            if spilled.isdisjoint(uses) and spilled.isdisjoint(defs):
+                code.append(ins)
+                continue
+            temps: dict[int, Operand] = {}
+            operands = list(ins.operands)
+            for o,opr in enumerate(operands):
+                if opr.type == OpType.REGISTER and opr.value in spilled:
+                    temp = temps.get(opr.value)
+                    if temp is None:
+                        temp = opr.withValue(program.registers.fresh())
+                        fixed.add(temp.value)
+                        temps[opr.value] = temp
+                    operands[o] = temp
+            before: list[Instruction] = []
+            after: list[Instruction] = []
+            for reg,temp in temps.items():
+                address = Operand(OpType.ADDRESS, str(heap + slots[reg]))
+                if reg in uses:
+                    before.append(Instruction("IMM", [temp, address]))
+                    before.append(Instruction("LOD", [temp, temp]))
+                if reg in defs:
+                    pointer = temp.withValue(program.registers.fresh())
+                    fixed.add(pointer.value)
+                    after.append(Instruction("IMM", [pointer, address]))
+                    after.append(Instruction("STR", [pointer, temp]))
+            rewritten = Instruction(ins.opcode, operands, ins.labels)
+            if before:
+                before[0].labels = rewritten.labels
+                rewritten.labels = []
+            code += before
+            code.append(rewritten)
+            code += after
+        return code
+
+    def toString(self):
+        limit = "no limit" if self.budget is None else f"at most {self.budget}"
+        out = f"Register allocation: {self.virtual} registers in {self.allocated} ({limit}) after {self.rounds} rounds"
+        if self.spilled:
+            out += f", {self.spilled} spilled to memory"
+        return out
@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+from program import Program
+from translator import Translator
+import multiprocessing
+import glob
+import os
+
+# The translators of a worker process
+worker: "tuple[Translator, Translator] | None" = None
+
+def initWorker(translator: Translator, translatorISA: Translator):
+    global worker
+    worker = (translator, translatorISA)
+
+def translateFile(filename: str, output: str):
+    # Returns (source instructions, core instructions, error) for one file
+    translator, translatorISA = worker
+    try:
+        main = Program.parseFile(filename)
+        read = len(main.code)
+        main = translator.translate(main)
+        main.makeRegsNumeric()
+        main.relativesToLabels()
+        with open(output, "w+") as f:
+            translatorISA.writeISA(main, f)
+        return read, len(main.code), None
+    except Exception as e:
+        return 0, 0, f"{type(e).__name__}: {e}"
+
+class Batch():
+    # Translates many files against one target in a single process, or a pool
+    # of them, with the translators loaded once
+    def __init__(self, translator: Translator, translatorISA: Translator, target: str, outdir: "str | None"=None, jobs: int=1):
+        self.translator = translator
+        self.translatorISA = translatorISA
+        # Outputs are named after the input and the target, 'prog/x.urcl' to
+        # 'isa/example.utrx' is written to 'x.example' in outdir or next to it
+        self.suffix = os.path.splitext(os.path.basename(target))[0]
+        self.outdir = outdir
+        self.jobs = jobs
+        self.files = 0
+        self.failed = 0
+        self.read = 0
+        self.written = 0
+        self.time = 0.0
+
+    @staticmethod
+    def collect(source: str):
+        # A directory (searched recursively), a glob, or a manifest listing one
+        # file per line relative to the manifest
+        if os.path.isdir(source):
+            return sorted(glob.glob(os.path.join(source, "**", "*.urcl"), recursive=True))
+        if glob.has_magic(source):
+            return sorted(glob.glob(source, recursive=True))
+        folder = os.path.dirname(source)
+        files: list[str] = []
+        with open(source, "r") as f:
+            for line in f:
+                line = line.split("//")[0].strip()
+                if line:
+                    files.append(os.path.join(folder, line))
+        return files
+
+    def output(self, filename: str):
+        name = f"{os.path.splitext(os.path.basename(filename))[0]}.{self.suffix}"
+        return os.path.join(self.outdir if self.outdir is not None else os.path.dirname(filename), name)
+
+    def run(self, files: list[str]):
+        # Yields (filename, output, source instructions, core instructions,
+        # error) for every file, in order
+        start = timer()
+        outputs = [self.output(filename) for filename in files]
+        if self.outdir is not None:
+            os.makedirs(self.outdir, exist_ok=True)
+        if self.jobs <= 1:
+            initWorker(self.translator, self.translatorISA)
+            results = map(translateFile, files, outputs)
+            yield from self.tally(files, outputs, results)
+        else:
+            context = None
+            if "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(self.jobs, context, initWorker, (self.translator, self.translatorISA)) as pool:
+                yield from self.tally(files, outputs, pool.map(translateFile, files, outputs))
+        self.time = timer() - start
+
+    def tally(self, files: list[str], outputs: list[str], results):
+        for filename,output,(read,written,error) in zip(files, outputs, results):
+            self.files += 1
+            if error is not None:
+                self.failed += 1
+            self.read += read
+            self.written += written
+            yield filename, output, read, written, error
+
+    def toString(self):
+        rate = lambda n: n / self.time if self.time else 0
+        out = f"{self.files} files ({self.failed} failed) in {self.time:.10f} seconds.\n"
+        out += f"{self.read} instructions in, {self.written} core instructions out.\n"
+        out += f"{rate(self.files):.1f} files/s, {rate(self.read):.1f} instructions/s."
+        return out
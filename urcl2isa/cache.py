@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Registers
+
+class Template():
+    # A fully expanded sub-program with the operands of the instruction it came
+    # from cut out. Operand slots are ("ph", i), bound to operand i of the
+    # instruction being expanded, ("tmp", operand), a temporary register that
+    # gets a fresh ID, or ("lit", operand). Operands never change, so literals
+    # are shared by every instantiation.
+    __slots__ = ("code",)
+
+    def __init__(self, program: Program, operands: list[Operand]):
+        self.code: list[tuple] = []
+        for ins in program.code:
+            slots = []
+            for opr in ins.operands:
+                slot = None
+                for i,o in enumerate(operands):
+                    if o is opr:
+                        slot = ("ph", i)
+                        break
+                if slot is None:
+                    # Literal registers other than R0 are all temporaries of the
+                    # expansion
+                    if opr.type == OpType.REGISTER and opr.value != 0:
+                        slot = ("tmp", opr)
+                    else:
+                        slot = ("lit", opr)
+                slots.append(slot)
+            self.code.append((ins.opcode, tuple(ins.labels), tuple(slots)))
+
+    def instantiate(self, operands: list[Operand], registers: Registers):
+        temps: dict[int, int] = {}
+        code: list[Instruction] = []
+        for opcode,labels,slots in self.code:
+            bound = []
+            for kind,opr in slots:
+                if kind == "ph":
+                    bound.append(operands[opr])
+                elif kind == "lit":
+                    bound.append(opr)
+                else:
+                    if opr.value not in temps:
+                        temps[opr.value] = registers.fresh()
+                    bound.append(opr.withValue(temps[opr.value]))
+            code.append(Instruction(opcode, bound, list(labels)))
+        return Program(code, {}, list(temps.values()), registers)
+
+
+class ExpansionCache():
+    __slots__ = ("maxSize", "exact", "entries", "hits", "misses", "evictions")
+
+    # Bounded LRU cache of fully expanded URCL, keyed by instruction signature.
+    # A signature keeps everything a case can test: operand types and type
+    # classes, equality between operands and, unless it's
+    # irrelevant, operand values. Every temporary is fresh, so registers other
+    # than R0 only matter through equality unless some case tests values, and
+    # 'SUB R3 R2 R1' and 'SUB R7 R5 R4' share an entry. Entries keep labels as
+    # the finished sub-program had them, before it's spliced in, and a hit is
+    # spliced like a miss, so label numbering comes out the same either way.
+    # That needs every instruction to own its label list, a list shared with
+    # another instruction would be renamed once for each of them on a miss.
+    def __init__(self, maxSize: int=4096, exact: bool=False):
+        self.maxSize = maxSize
+        self.exact = exact
+        self.entries: "OrderedDict[tuple, Template | None]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def signature(self, ins: Instruction):
+        key = [ins.opcode]
+        for o,opr in enumerate(ins.operands):
+            equal = o
+            for i in range(o):
+                if ins.operands[i].type == opr.type and ins.operands[i].value == opr.value:
+                    equal = i
+                    break
+            if not self.exact and opr.type == OpType.REGISTER and opr.value != 0:
+                key.append((opr.type, opr.typeClass, "=", equal))
+            else:
+                key.append((opr.type, opr.typeClass, opr.value))
+        return tuple(key)
+
+    def get(self, key: tuple):
+        # Returns False for an unknown key, None for an instruction with no
+        # expansion, and a Template otherwise.
+        entry = self.entries.get(key, False)
+        if entry is not False:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: "Template | None"):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def toString(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1f}%), {self.evictions} evictions, {len(self.entries)}/{self.maxSize} entries"
@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+from program import Program
+from translator import Translator
+from addresses import Addresses
+from isa import Block
+import multiprocessing
+import os
+
+# The core code of a worker process, the translators of every target, and the
+# word size to give labels addresses in, if they get them
+worker: "tuple[Program, dict[str, Translator], int | None] | None" = None
+
+def initWorker(program: Program, translators: dict[str, Translator], wordSize: "int | None"):
+    global worker
+    worker = (program, translators, wordSize)
+
+def emitTarget(target: str, output: str):
+    # Returns (words of code if labels got addresses, error) for one target
+    program, translators, wordSize = worker
+    translator = translators[target]
+    try:
+        with open(output, "w+") as f:
+            if wordSize is None:
+                translator.writeISA(program, f)
+                return None, None
+            addresses = Addresses(translator, wordSize)
+            Block.write(addresses.resolve(program), f)
+            return addresses.size, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+class FanOut():
+    # Translates one program's core URCL to several targets, each written to a
+    # file of its own. Everything up to core URCL is shared, only emission is
+    # done per target, by a pool of processes if there's more than one job.
+    def __init__(self, translators: dict[str, Translator], outdir: "str | None"=None, jobs: int=1, wordSize: "int | None"=None):
+        self.translators = translators
+        self.outdir = outdir
+        self.jobs = jobs
+        self.wordSize = wordSize
+        self.targets = 0
+        self.failed = 0
+        self.time = 0.0
+
+    def output(self, filename: str, target: str):
+        # Named like batch outputs, 'prog/x.urcl' to 'isa/example.utrx' is
+        # written to 'x.example' in outdir or next to the input
+        name = f"{os.path.splitext(os.path.basename(filename))[0]}.{os.path.splitext(os.path.basename(target))[0]}"
+        return os.path.join(self.outdir if self.outdir is not None else os.path.dirname(filename), name)
+
+    def run(self, program: Program, filename: str):
+        # Yields (target, output, words of code, error) for every target, in
+        # order. Words of code are None unless labels get addresses.
+        start = timer()
+        targets = list(self.translators)
+        outputs = [self.output(filename, target) for target in targets]
+        if len(set(outputs)) < len(outputs):
+            raise ValueError("Cannot write every target to a file of its own, some are named the same.")
+        if self.outdir is not None:
+            os.makedirs(self.outdir, exist_ok=True)
+        if self.jobs <= 1 or len(targets) < 2:
+            initWorker(program, self.translators, self.wordSize)
+            results = map(emitTarget, targets, outputs)
+            yield from self.tally(targets, outputs, results)
+        else:
+            context = None
+            if "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+            jobs = min(self.jobs, len(targets))
+            with ProcessPoolExecutor(jobs, context, initWorker, (program, self.translators, self.wordSize)) as pool:
+                yield from self.tally(targets, outputs, pool.map(emitTarget, targets, outputs))
+        self.time = timer() - start
+
+    def tally(self, targets: list[str], outputs: list[str], results):
+        for target,output,(words,error) in zip(targets, outputs, results):
+            self.targets += 1
+            if error is not None:
+                self.failed += 1
+            yield target, output, words, error
+
+    def toString(self):
+        return f"{self.targets} targets ({self.failed} failed) in {self.time:.10f} seconds."
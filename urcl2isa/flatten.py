@@ -0,0 +1,213 @@
+from itertools import count
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program
+from UTRX import Translation, Case, Body
+
+class Flattener():
+    # Expands the URCL tables into themselves once, when they're loaded, so
+    # instructions expand most of the way down to core URCL in one step instead
+    # of a step for every rule in between. Every instruction of a case body that
+    # matches the same case whatever the operands of the outer case are, is
+    # replaced by the flattened body of that case. That gets decided by matching
+    # it with operands of every shape the outer case allows, each equal to an
+    # operand before it or not. Instructions that could go more than one way
+    # stay in the body and are expanded while translating, and so do ones whose
+    # expansions have labels, which are renamed for every expansion.
+    # Bodies that certainly lead back to themselves would never stop expanding.
+    # The chain of cases in between is kept to report, and the instruction that
+    # closes it left in the body.
+
+    # An operand of every (type, type class) source code can have
+    samples = [Operand.parse(word) for word in ["R1", "R0", "Rx", "5", "0", "-1", "M4", ".label", "%5", "~+1", "@MAX"]] \
+            + [Operand(OpType.STACKPTR, "SP")]
+
+    def __init__(self, translations: dict[str, Translation]):
+        self.translations = translations
+        # Value tests make a match depend on more than the shape of operands
+        self.tested = {opcode for opcode,translation in translations.items()
+                       if any(pattern is not None and not pattern.typeOnly for case in translation.cases for pattern in case.patterns)}
+        self.flat: dict[Case, Body] = {}
+        # Cases being flattened, outermost first
+        self.path: list[tuple[str, Case]] = []
+        self.cycles: list[str] = []
+        self.values = count(1 << 20)
+        # What the last run did
+        self.inlined = 0
+        self.left = 0
+
+    def run(self):
+        self.inlined = 0
+        self.left = 0
+        for opcode,translation in self.translations.items():
+            for case in translation.cases:
+                if case.body is not None:
+                    case.flat = self.flatten(opcode, case)
+        return self.translations
+
+    def flatten(self, opcode: str, case: Case):
+        # The flattened body, or None if the case is already being flattened
+        flat = self.flat.get(case)
+        if flat is not None:
+            return flat
+        for c,(_,other) in enumerate(self.path):
+            if other is case:
+                chain = Flattener.chain(self.path[c:] + [(opcode, case)])
+                if chain not in self.cycles:
+                    self.cycles.append(chain)
+                return None
+        self.path.append((opcode, case))
+        shapes = self.shapes(case)
+        code: list[tuple] = []
+        # Temporaries by (instruction they were inlined for, value), every
+        # inlined body gets its own
+        temps: dict[tuple, Operand] = {}
+        values = count(1)
+        final = True
+        for s,(subOpcode,labels,slots) in enumerate(case.body.code):
+            found = self.resolve(subOpcode, slots, shapes)
+            # Matching can swap the operands of an instruction that then doesn't
+            # expand, and that's left to translation to do
+            if found is not None and found[0] is None and found[1] != tuple(range(len(slots))):
+                found = None
+            if found is None:
+                final = False
+                self.left += 1
+            else:
+                subCase, order = found
+                # Matching can swap operands around, which sticks
+                slots = tuple(slots[o] for o in order)
+                if subCase is not None:
+                    # Bodies that don't parse raise their error while translating
+                    inner = None if subCase.body is None else self.flatten(subOpcode, subCase)
+                    if inner is not None and not labels and not Flattener.labelled(inner) and Flattener.reaches(inner, len(slots)):
+                        self.inlined += 1
+                        final = final and inner.final
+                        for innerOpcode,innerLabels,innerSlots in inner.code:
+                            bound = []
+                            for kind,value in innerSlots:
+                                if kind == "ph":
+                                    bound.append(Flattener.rename(slots[value], temps, -1, values))
+                                else:
+                                    bound.append(Flattener.rename((kind, value), temps, s, values))
+                            code.append((innerOpcode, innerLabels, tuple(bound)))
+                        continue
+                    final = False
+                    self.left += 1
+            code.append((subOpcode, labels, tuple(Flattener.rename(slot, temps, -1, values) for slot in slots)))
+        self.path.pop()
+        flat = Body(tuple(code), final)
+        self.flat[case] = flat
+        return flat
+
+    @staticmethod
+    def chain(path: list[tuple[str, Case]]):
+        return " -> ".join(f"{opcode} :: {case.string.strip()}" for opcode,case in path)
+
+    @staticmethod
+    def rename(slot: tuple, temps: dict[tuple, Operand], owner: int, values):
+        kind, opr = slot
+        if kind != "tmp":
+            return slot
+        new = temps.get((owner, opr.value))
+        if new is None:
+            new = opr.withValue(next(values))
+            temps[(owner, opr.value)] = new
+        return ("tmp", new)
+
+    @staticmethod
+    def labelled(body: Body):
+        return any(labels for _,labels,_ in body.code)
+
+    @staticmethod
+    def reaches(body: Body, operands: int):
+        # Whether every operand the body uses is there
+        return all(value < operands for _,_,slots in body.code for kind,value in slots if kind == "ph")
+
+    def shapes(self, case: Case):
+        # Samples of what each operand of the case can be like
+        patterns = [pattern for pattern in case.patterns if pattern is not None]
+        return [[opr for opr in Flattener.samples if pattern.matchType(opr.typeClass)] for pattern in patterns]
+
+    def resolve(self, opcode: str, slots: tuple, shapes: list[list[Operand]]):
+        # (case, where each operand ends up) for an instruction of a body, or
+        # None if that depends on the operands of the body. The case is None
+        # when it certainly doesn't expand.
+        translation = self.translations.get(opcode)
+        if translation is None:
+            return (None, tuple(range(len(slots))))
+        if opcode in self.tested:
+            return None
+        outcome = None
+        for operands in self.operands(slots, shapes):
+            matched = list(operands)
+            try:
+                case = Instruction(opcode, matched).matchCase(translation)
+            except Exception:
+                return None
+            order = []
+            for opr in matched:
+                for o,other in enumerate(operands):
+                    if other is opr:
+                        order.append(o)
+                        break
+            found = (case, tuple(order))
+            if outcome is None:
+                outcome = found
+            elif found[0] is not outcome[0] or found[1] != outcome[1]:
+                return None
+        return outcome
+
+    def operands(self, slots: tuple, shapes: list[list[Operand]]):
+        # Every way the operands of an instruction of a body can be, as far as
+        # matching can tell them apart. Everything but placeholders is known.
+        fixed: list["Operand | None"] = []
+        temps: dict[int, Operand] = {}
+        for kind,value in slots:
+            if kind == "ph":
+                fixed.append(None)
+            elif kind == "tmp":
+                if value.value not in temps:
+                    temps[value.value] = value.withValue(next(self.values))
+                fixed.append(temps[value.value])
+            elif kind == "const":
+                fixed.append(value.withValue(Program.constant(value.value), OpType.NUMBER))
+            else:
+                fixed.append(value)
+        # Temporaries are never the same as anything else
+        known = [opr for (kind,_),opr in zip(slots, fixed) if kind in ["lit", "const"]]
+        return self.choose(slots, shapes, fixed, known, 0)
+
+    def choose(self, slots: tuple, shapes: list[list[Operand]], chosen: list, known: list[Operand], at: int):
+        if at == len(slots):
+            yield chosen
+            return
+        kind, value = slots[at]
+        if kind != "ph":
+            yield from self.choose(slots, shapes, chosen, known, at + 1)
+            return
+        for s in range(at):
+            # Already chosen for the same placeholder
+            if slots[s] == slots[at]:
+                yield from self.choose(slots, shapes, chosen[:at] + [chosen[s]] + chosen[at+1:], known, at + 1)
+                return
+        allowed = shapes[value] if value < len(shapes) else Flattener.samples
+        kinds = {(opr.type, opr.typeClass) for opr in allowed}
+        options = [self.fresh(sample) for sample in allowed]
+        # Or the same as a known operand, or a placeholder before it
+        for other in known + [chosen[s] for s in range(at) if slots[s][0] == "ph"]:
+            if (other.type, other.typeClass) in kinds:
+                options.append(Operand(other.type, other.value, other.word, other.extra, other.typeClass))
+        for option in options:
+            yield from self.choose(slots, shapes, chosen[:at] + [option] + chosen[at+1:], known, at + 1)
+
+    def fresh(self, sample: Operand):
+        # An operand like sample that isn't the same as any other, but R0 and 0
+        if sample.type == OpType.REGISTER:
+            return sample.withValue(0 if sample.value == "0" else next(self.values))
+        if "Z" in sample.typeClass:
+            return sample.withValue(sample.value)
+        return sample.withValue(f"{sample.value}_{next(self.values)}")
+
+    def toString(self):
+        return f"Flattened tables: {self.inlined} expansions inlined, {self.left} left to translation"
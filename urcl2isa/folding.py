@@ -0,0 +1,234 @@
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program
+
+class Folder():
+    # Constant propagation, folding and dead code removal on URCL before it's
+    # expanded. Registers known to hold a constant are followed forward through
+    # straight line code, until a label (anything could jump there) or a call.
+    # An instruction whose operands are all known is replaced by an IMM of its
+    # result in the word size, a branch they decide becomes a jump or goes, and
+    # instructions after a jump, RET or HLT up to the next label can't be
+    # reached. Jumps are written 'BGE target R0 R0', which is core URCL.
+    # Relative jumps count core instructions, so whatever they could jump
+    # across, and the jump itself, is left as it is. Data isn't code and stays.
+    # Instructions it doesn't know might write every register they have.
+    unary = {
+        "IMM": lambda b, w: b,
+        "MOV": lambda b, w: b,
+        "INC": lambda b, w: b + 1,
+        "DEC": lambda b, w: b - 1,
+        "NEG": lambda b, w: -b,
+        "NOT": lambda b, w: ~b,
+        "LSH": lambda b, w: b << 1,
+        "RSH": lambda b, w: b >> 1,
+        "SRS": lambda b, w: Folder.signed(b, w) >> 1,
+    }
+    binary = {
+        "ADD":  lambda b, c, w: b + c,
+        "SUB":  lambda b, c, w: b - c,
+        "MLT":  lambda b, c, w: b * c,
+        "DIV":  lambda b, c, w: b // c if c else None,
+        "MOD":  lambda b, c, w: b % c if c else None,
+        "AND":  lambda b, c, w: b & c,
+        "OR":   lambda b, c, w: b | c,
+        "XOR":  lambda b, c, w: b ^ c,
+        "NOR":  lambda b, c, w: ~(b | c),
+        "NAND": lambda b, c, w: ~(b & c),
+        "XNOR": lambda b, c, w: ~(b ^ c),
+        "BSL":  lambda b, c, w: b << min(c, w),
+        "BSR":  lambda b, c, w: b >> min(c, w),
+        "BSS":  lambda b, c, w: Folder.signed(b, w) >> min(c, w),
+        "SETE":  lambda b, c, w: int(b == c),
+        "SETNE": lambda b, c, w: int(b != c),
+        "SETL":  lambda b, c, w: int(b < c),
+        "SETG":  lambda b, c, w: int(b > c),
+        "SETLE": lambda b, c, w: int(b <= c),
+        "SETGE": lambda b, c, w: int(b >= c),
+        "SETC":  lambda b, c, w: int(b + c >= 1 << w),
+        "SETNC": lambda b, c, w: int(b + c < 1 << w),
+        "SSETL":  lambda b, c, w: int(Folder.signed(b, w) < Folder.signed(c, w)),
+        "SSETG":  lambda b, c, w: int(Folder.signed(b, w) > Folder.signed(c, w)),
+        "SSETLE": lambda b, c, w: int(Folder.signed(b, w) <= Folder.signed(c, w)),
+        "SSETGE": lambda b, c, w: int(Folder.signed(b, w) >= Folder.signed(c, w)),
+    }
+    # Whether a branch is taken, from the operands after its target
+    tests = {
+        "BRZ": lambda b, w: b == 0,
+        "BNZ": lambda b, w: b != 0,
+        "BRP": lambda b, w: b >> (w - 1) == 0,
+        "BRN": lambda b, w: b >> (w - 1) == 1,
+        "BEV": lambda b, w: b % 2 == 0,
+        "BOD": lambda b, w: b % 2 == 1,
+    }
+    comparisons = {
+        "BRE": lambda b, c, w: b == c,
+        "BNE": lambda b, c, w: b != c,
+        "BRL": lambda b, c, w: b < c,
+        "BRG": lambda b, c, w: b > c,
+        "BLE": lambda b, c, w: b <= c,
+        "BGE": lambda b, c, w: b >= c,
+        "BRC": lambda b, c, w: b + c >= 1 << w,
+        "BNC": lambda b, c, w: b + c < 1 << w,
+        "SBRL": lambda b, c, w: Folder.signed(b, w) < Folder.signed(c, w),
+        "SBRG": lambda b, c, w: Folder.signed(b, w) > Folder.signed(c, w),
+        "SBLE": lambda b, c, w: Folder.signed(b, w) <= Folder.signed(c, w),
+        "SBGE": lambda b, c, w: Folder.signed(b, w) >= Folder.signed(c, w),
+    }
+    ends = {"JMP", "RET", "HLT"}
+    data = {"DW"}
+    zero = Operand.parse("R0").withValue(0)
+
+    def __init__(self, wordSize: int=8):
+        self.wordSize = wordSize
+        # What the last run did
+        self.before = 0
+        self.after = 0
+        self.folded = 0
+        self.decided = 0
+        self.removed: dict[str, int] = {}
+
+    @staticmethod
+    def signed(value: int, wordSize: int):
+        return value - (1 << wordSize) if value >> (wordSize - 1) & 1 else value
+
+    def value(self, opr: Operand, known: dict[int, int]):
+        # The value of an operand in the word size, or None if it isn't known
+        if opr.word:
+            return None
+        if opr.type == OpType.REGISTER:
+            return 0 if opr.value == 0 else known.get(opr.value)
+        if opr.type not in [OpType.NUMBER, OpType.NEGATIVE]:
+            return None
+        try:
+            value = int(opr.value)
+        except ValueError:
+            return None
+        if opr.type == OpType.NEGATIVE:
+            value = -value
+        return value & ((1 << self.wordSize) - 1)
+
+    def run(self, program: Program):
+        code = program.code
+        self.before = len(code)
+        self.folded = 0
+        self.decided = 0
+        self.removed = {}
+        pinned = Folder.pin(code)
+        mask = (1 << self.wordSize) - 1
+        out: list[Instruction] = []
+        known: dict[int, int] = {}
+        dead = False
+        for i,ins in enumerate(code):
+            if ins.labels or i in pinned:
+                known = {}
+                dead = False
+            if dead and ins.opcode not in Folder.data:
+                self.removed[ins.opcode] = self.removed.get(ins.opcode, 0) + 1
+                continue
+            if i in pinned:
+                for opr in ins.operands:
+                    if opr.type == OpType.REGISTER:
+                        known.pop(opr.value, None)
+                out.append(ins)
+                continue
+            new, result = self.fold(ins, known)
+            if new is None:
+                # A branch that's never taken, its labels go to what follows
+                if i + 1 < len(code):
+                    code[i+1].labels[:0] = ins.labels
+                elif ins.labels:
+                    out.append(ins)
+                    continue
+                self.decided += 1
+                self.removed[ins.opcode] = self.removed.get(ins.opcode, 0) + 1
+                continue
+            ins = new
+            if ins.opcode == "CAL":
+                known = {}
+            elif result is not None:
+                known[ins.operands[0].value] = result & mask
+            elif ins.opcode in Folder.unary or ins.opcode in Folder.binary:
+                known.pop(ins.operands[0].value, None)
+            elif ins.opcode not in Folder.tests and ins.opcode not in Folder.comparisons:
+                for opr in ins.operands:
+                    if opr.type == OpType.REGISTER:
+                        known.pop(opr.value, None)
+            dead = Folder.unconditional(ins)
+            out.append(ins)
+        program.code = out
+        self.after = len(out)
+        return program
+
+    def fold(self, ins: Instruction, known: dict[int, int]):
+        # (what to put in place of ins, the value it writes if that's known).
+        # None in place of it if it's a branch that's never taken.
+        operands = ins.operands
+        opcode = ins.opcode
+        test = Folder.tests.get(opcode)
+        arity = 1
+        if test is None:
+            test = Folder.comparisons.get(opcode)
+            arity = 2
+        if test is not None:
+            values = [self.value(opr, known) for opr in operands[1:]]
+            if len(values) != arity or None in values:
+                return ins, None
+            if not test(*values, self.wordSize):
+                return None, None
+            if Folder.unconditional(ins):
+                return ins, None
+            self.decided += 1
+            return Instruction("BGE", [operands[0], Folder.zero, Folder.zero], ins.labels), None
+        arity = 1 if opcode in Folder.unary else 2 if opcode in Folder.binary else None
+        if arity is None or len(operands) != arity + 1:
+            return ins, None
+        dst = operands[0]
+        if dst.type != OpType.REGISTER or dst.value == 0 or dst.word:
+            return ins, None
+        values = [self.value(opr, known) for opr in operands[1:]]
+        if None in values:
+            return ins, None
+        if arity == 1:
+            result = Folder.unary[opcode](*values, self.wordSize)
+        else:
+            result = Folder.binary[opcode](*values, self.wordSize)
+        if result is None:
+            return ins, None
+        result &= (1 << self.wordSize) - 1
+        number = Operand(OpType.NUMBER, str(result))
+        if opcode == "IMM" and operands[1].type == OpType.NUMBER and operands[1].value == number.value:
+            return ins, result
+        self.folded += 1
+        return Instruction("IMM", [dst, number], ins.labels), result
+
+    @staticmethod
+    def unconditional(ins: Instruction):
+        if ins.opcode in Folder.ends:
+            return True
+        return ins.opcode == "BGE" and len(ins.operands) == 3 and all(opr.type == OpType.REGISTER and opr.value == 0 for opr in ins.operands[1:])
+
+    @staticmethod
+    def pin(code: list[Instruction]):
+        # Indices of every instruction a relative jump could land on or jump
+        # across, and of the jump. Every instruction is at least one core
+        # instruction, so that's as far in source instructions at most.
+        pinned: set[int] = set()
+        for i,ins in enumerate(code):
+            for opr in ins.operands:
+                if opr.type != OpType.RELATIVE:
+                    continue
+                try:
+                    offset = int(opr.value)
+                except ValueError:
+                    offset = len(code)
+                low, high = (i, i + offset) if offset >= 0 else (i + offset, i)
+                pinned.update(range(max(low, 0), min(high, len(code) - 1) + 1))
+        return pinned
+
+    def toString(self):
+        removed = self.before - self.after
+        out = f"Constant folding: {self.before} -> {self.after} instructions, {self.folded} folded, {self.decided} branches decided, {removed} removed"
+        for opcode,count in sorted(self.removed.items(), key=lambda a: -a[1]):
+            out += f"\n{count:>10}  {opcode}"
+        return out
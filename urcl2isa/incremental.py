@@ -0,0 +1,195 @@
+from bisect import bisect_left
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Registers, Numbering
+from translator import Translator
+from isa import Block
+import hashlib
+import os
+import pickle
+
+class Incremental():
+    # Translates a file again after it changes, redoing as little as it can.
+    # Source instructions before the first changed line keep their expanded and
+    # numbered core code, along with the numbering and label state after each
+    # of them, and everything after goes through the translator's expansion
+    # cache. ISA code is cached by the content of each core instruction. Both
+    # caches are saved next to the source file between runs, the per-line state
+    # only lives as long as the process.
+    version = 1
+
+    def __init__(self, translator: Translator, translatorISA: Translator, tables: list[str], cacheSize: int=1 << 18):
+        self.translator = translator
+        self.translatorISA = translatorISA
+        # Cached results are only good for the same tables
+        digest = hashlib.sha256(str(Incremental.version).encode())
+        for table in tables:
+            with open(table, "rb") as f:
+                digest.update(f.read())
+        self.digest = digest.hexdigest()
+        self.cacheSize = cacheSize
+        self.blocks: dict[tuple, "list[str] | str"] = {}
+        self.reset()
+
+    def reset(self):
+        self.lines: list[str] = []
+        self.out: list[Block] = []
+        self.registers = Registers()
+        self.headers: dict[int, str] = {}
+        self.numbering = Numbering()
+        # For each source instruction its line, and after it (core length,
+        # registers of the program's own numbered, numbers handed out, uid)
+        self.positions: list[int] = []
+        self.marks: list[tuple[int, int, int, int]] = []
+        # Numbered core code with the ISA code of each instruction, None until
+        # it's known, and which instructions have relative jumps in them
+        self.core: list[Instruction] = []
+        self.bodies: list["list[str] | str | None"] = []
+        self.relatives: list[int] = []
+        self.uid = 0
+        # A NOP can only be the last instruction, and would merge into anything
+        # added after it
+        self.trailingNop = False
+        # What the last run did
+        self.reused = 0
+        self.expanded = 0
+        self.blockHits = 0
+        self.blockMisses = 0
+
+    def run(self, lines: list[str]):
+        if lines == self.lines and self.lines:
+            self.reused, self.expanded = len(self.marks), 0
+            return self.out
+        same = 0
+        limit = min(len(lines), len(self.lines))
+        while same < limit and lines[same] == self.lines[same]:
+            same += 1
+        keep = bisect_left(self.positions, same)
+        if keep and keep == len(self.positions) and self.trailingNop:
+            keep -= 1
+        del self.positions[keep:]
+        del self.marks[keep:]
+        length, names, count, uid = self.marks[-1] if keep else (0, 0, 0, 0)
+        del self.core[length:]
+        del self.bodies[length:]
+        del self.relatives[bisect_left(self.relatives, length):]
+        self.numbering.rewind(names, count)
+        start = self.positions[-1] + 1 if keep else 0
+        self.reused = keep
+        self.expanded = 0
+        self.trailingNop = False
+
+        positions: list[int] = []
+        for ins in Program.tokenize(lines[start:], registers=self.registers, headers=self.headers, positions=positions):
+            self.trailingNop = ins.opcode == "NOP"
+            self.numbering.begin(ins)
+            sub = Program([ins], registers=self.registers)
+            sub.uid = uid
+            self.translator.translate(sub)
+            uid = sub.uid
+            for core in sub.code:
+                self.numbering.number(core)
+                for opr in core.operands:
+                    if opr.type == OpType.RELATIVE:
+                        self.relatives.append(len(self.core))
+                        break
+                self.core.append(core)
+                self.bodies.append(None)
+            self.marks.append((len(self.core), len(self.numbering.numbers), self.numbering.count, uid))
+            self.expanded += 1
+        self.positions += [p + start for p in positions]
+        self.lines = lines
+        self.uid = uid
+        self.out = self.emit()
+        return self.out
+
+    def labelRelatives(self):
+        # Program.relativesToLabels without touching the core code. Returns the
+        # labels it adds by instruction, and the instructions it rewrites.
+        code = self.core
+        uid = self.uid
+        labels: dict[int, list[str]] = {}
+        rewritten: dict[int, Instruction] = {}
+        for i in self.relatives:
+            ins = code[i]
+            operands = list(ins.operands)
+            for o,opr in enumerate(operands):
+                if opr.type == OpType.RELATIVE:
+                    # Indexed like a list, so jumps back past the start wrap
+                    target = range(len(code))[i + int(opr.value)]
+                    labels.setdefault(target, []).append(f"{ins.opcode}_{uid}")
+                    operands[o] = Operand.parse(f".{ins.opcode}_{uid}")
+                    uid += 1
+            rewritten[i] = Instruction(ins.opcode, operands, ins.labels)
+        return labels, rewritten
+
+    def emit(self):
+        self.blockHits = 0
+        self.blockMisses = 0
+        labels, rewritten = self.labelRelatives()
+        out: list[Block] = []
+        for i,ins in enumerate(self.core):
+            body = self.bodies[i]
+            if body is None:
+                body = self.body(rewritten.get(i, ins))
+                if i not in rewritten:
+                    self.bodies[i] = body
+            elif i in rewritten:
+                body = self.body(rewritten[i])
+            else:
+                self.blockHits += 1
+            extra = labels.get(i)
+            out.append(Block(ins.labels if extra is None else ins.labels + extra, body))
+        return out
+
+    def body(self, ins: Instruction):
+        key = (ins.opcode, tuple((opr.type, opr.value, opr.word, opr.typeClass) for opr in ins.operands))
+        body = self.blocks.get(key)
+        if body is None:
+            self.blockMisses += 1
+            # Matching can swap operands around, so it gets its own list
+            body = self.translatorISA.substitute(Instruction(ins.opcode, list(ins.operands), ins.labels))
+            if len(self.blocks) >= self.cacheSize:
+                self.blocks.clear()
+            self.blocks[key] = body
+        else:
+            self.blockHits += 1
+        return body
+
+    def toString(self):
+        return f"{self.reused} instructions reused, {self.expanded} expanded, {self.blockHits} ISA blocks cached, {self.blockMisses} translated"
+
+    @staticmethod
+    def cachePath(filename: str, target: str):
+        folder, name = os.path.split(os.path.abspath(filename))
+        return os.path.join(folder, "__pycache__", f"{name}.{os.path.basename(target)}.v{Incremental.version}.pickle")
+
+    def load(self, path: str):
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["digest"] != self.digest:
+                return
+            self.blocks = cached["blocks"]
+            cache = self.translator.cache
+            cache.entries = cached["expansions"]
+            while len(cache.entries) > cache.maxSize:
+                cache.entries.popitem(last=False)
+        except Exception:
+            # Missing, stale or unreadable, start from nothing
+            pass
+
+    def save(self, path: str):
+        cached = {
+            "digest": self.digest,
+            "blocks": self.blocks,
+            "expansions": self.translator.cache.entries,
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, "wb") as f:
+                pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except OSError:
+            pass
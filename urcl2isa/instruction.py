@@ -1,20 +1,22 @@
 from operand import Operand
-from UTRX import Case
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from translator import Translation
+    from UTRX import Translation
+    from profiler import MatchStats
 from colorama import Fore, Style
-import copy
 
 class Instruction():
+    __slots__ = ("opcode", "operands", "labels")
+
     # ======== Static variables ========
     # There are none
 
-    def __init__(self, opcode="NOP", operands:list["Operand"]=[], labels:list["Operand"]=[]):
-        # A unique ID to differentiate instructions with identical attribute values
+    def __init__(self, opcode="NOP", operands:"list[Operand] | None"=None, labels:"list[str] | None"=None):
         self.opcode = opcode
-        self.operands = operands
-        self.labels = labels
+        # Operands themselves are shared and never changed, but each instruction
+        # owns its lists
+        self.operands = [] if operands is None else operands
+        self.labels = [] if labels is None else labels
 
     @staticmethod
     def parse(instruction: str):
@@ -41,43 +43,40 @@ class Instruction():
 
     # ======== Instruction methods ========
 
-    def match(self, translation: "Translation"):
-        for case in translation.cases:
-            backup = self.operands
-            match = True
-            opNum = 0
-            infixes = ["==", "~~", "<>", "!=", "!~"]
-            for p,param in enumerate(case.params):
-                if param in infixes:
-                    op1 = self.operands[opNum]
-                    op2 = self.operands[(opNum + 1) % len(self.operands)]
-                    if param == "==" and (op1.value != op2.value or  op1.type != op2.type) \
-                    or param == "!=" and (op1.value == op2.value and op1.type == op2.type) \
-                    or param == "~~" and (op1.type != op2.type) \
-                    or param == "!~" and (op1.type == op2.type):
-                        match = False
-                        break
-                    if param == "<>":
-                        if not (Case.match(op1, case.params[p-1]) and Case.match(op2, case.params[(p+1) % len(case.params)])):
-                            if (Case.match(op2, case.params[p-1]) and Case.match(op1, case.params[(p+1) % len(case.params)])):
-                                self.operands[opNum] = op2
-                                self.operands[(opNum+1)%len(self.operands)] = op1
-                            else:
-                                match = False
-                                break
-                        opNum += 1
-                        continue
-                else:
-                    if param != case.params[-1]:
-                        if case.params[p+1] == "<>":
-                            continue
-                    if not Case.match(self.operands[opNum], param):
-                        match = False
-                        break
-                    opNum += 1
+    def match(self, translation: "Translation", stats: "MatchStats | None"=None):
+        case = self.matchCase(translation, stats)
+        if case is None:
+            return None
+        return list(case.code)
+
+    def matchCase(self, translation: "Translation", stats: "MatchStats | None"=None):
+        # Cases are tried in order, but the translation's index remembers for
+        # each operand shape how many leading cases are ruled out by types
+        # alone, and which case matches when that is decided by types too
+        key = tuple((opr.type, opr.typeClass) for opr in self.operands)
+        start, known = translation.index.get(key, (0, False))
+        if known:
+            case = translation.cases[start]
+            # Only matched again for the operands it swaps
+            if case.swaps:
+                case.matches(self.operands)
+            if stats is not None:
+                stats.match(translation, case, 1)
+            return case
+        skip = start
+        for c in range(start, len(translation.cases)):
+            case = translation.cases[c]
+            match, swapped = case.matches(self.operands)
             if match:
-                return copy.deepcopy(case.code)
-            self.operands = backup
+                translation.index[key] = (skip, case.typeOnly and skip == c)
+                if stats is not None:
+                    stats.match(translation, case, c - start + 1)
+                return case
+            if case.typeOnly and not swapped and skip == c:
+                skip = c + 1
+        translation.index[key] = (skip, False)
+        if stats is not None:
+            stats.match(translation, None, len(translation.cases) - start)
         return None
 
     def toString(self, indent=0):
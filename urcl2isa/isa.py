@@ -2,6 +2,8 @@ from typing import TYPE_CHECKING
 from operand import Operand 
 
 class Block():
+    separator = "\n | "
+
     def __init__(self, URCL_labels:list[Operand]=[], code:list[str]=[]):
         self.URCL_labels = URCL_labels
         self.code = code
@@ -11,5 +13,16 @@ class Block():
         out += f"\n{'':>{indent}} | ".join(ln for ln in self.code)
         return out
     
+    @staticmethod
+    def write(blocks: list["Block"], out, chunk: int=4096):
+        # toString() of every block on its own line, a chunk of them per write
+        parts: list[str] = []
+        for block in blocks:
+            parts.append(f"{' '.join(block.URCL_labels)} | {Block.separator.join(block.code)}\n")
+            if len(parts) >= chunk:
+                out.write("".join(parts))
+                parts.clear()
+        out.write("".join(parts))
+
     def print(self, indent=0):
         print(self.toString(indent=indent))
\ No newline at end of file
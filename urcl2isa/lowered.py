@@ -0,0 +1,220 @@
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program
+import hashlib
+import os
+
+class BinaryIR():
+    # Compact binary form of a lowered Program, which loads without parsing
+    # anything. After a header of magic and version, every string (opcodes,
+    # labels, operand values and type classes, header words) is in a table
+    # once, then every distinct operand once, as a tag byte and string IDs,
+    # then the headers, registers and instructions as IDs into those tables.
+    # Opcodes have a table of their own, so an instruction starts with one
+    # number for its opcode, how many operands it has (7 meaning the count
+    # follows) and whether labels follow. Numbers are unsigned LEB128 varints.
+    # The tag byte is the operand's OpType value, with the top bit set if the
+    # value is an int rather than a string.
+    # Loaded instructions share operands the way makeRegsNumeric leaves them.
+    magic = b"URCLIR"
+    version = 1
+    types = {opType.value: opType for opType in OpType}
+
+    @staticmethod
+    def varint(out: bytearray, n: int):
+        while n >= 0x80:
+            out.append(n & 0x7F | 0x80)
+            n >>= 7
+        out.append(n)
+
+    @staticmethod
+    def dumps(program: Program):
+        strings: dict[str, int] = {}
+        opcodes: dict[str, int] = {}
+        operands: dict[tuple, int] = {}
+        def string(s: str):
+            id = strings.get(s)
+            if id is None:
+                id = strings[s] = len(strings)
+            return id
+        def operand(opr: Operand):
+            if opr.extra is not None:
+                raise ValueError(f"Cannot store operand '{opr.toString()}', it has extra information.")
+            tag = opr.type.value | (0x80 if type(opr.value) is int else 0)
+            key = (tag, string(str(opr.value)), opr.word, string(opr.typeClass))
+            id = operands.get(key)
+            if id is None:
+                id = operands[key] = len(operands)
+            return id
+
+        body = bytearray()
+        varint = BinaryIR.varint
+        varint(body, len(program.headers))
+        for header,words in program.headers.items():
+            varint(body, header)
+            varint(body, len(words))
+            for word in words:
+                varint(body, string(word))
+        # Registers are numbered by now
+        varint(body, len(program.regs))
+        for reg in program.regs:
+            varint(body, string(str(reg)))
+        varint(body, len(program.code))
+        for ins in program.code:
+            opcode = opcodes.get(ins.opcode)
+            if opcode is None:
+                opcode = opcodes[ins.opcode] = len(opcodes)
+                string(ins.opcode)
+            count = len(ins.operands)
+            varint(body, opcode << 4 | min(count, 7) << 1 | bool(ins.labels))
+            if count >= 7:
+                varint(body, count - 7)
+            if ins.labels:
+                varint(body, len(ins.labels))
+                for label in ins.labels:
+                    varint(body, string(label))
+            for opr in ins.operands:
+                varint(body, operand(opr))
+
+        out = bytearray(BinaryIR.magic)
+        out.append(BinaryIR.version)
+        varint(out, len(strings))
+        for s in strings:
+            data = s.encode()
+            varint(out, len(data))
+            out += data
+        varint(out, len(operands))
+        for tag,value,word,typeClass in operands:
+            out.append(tag)
+            varint(out, value)
+            varint(out, word)
+            varint(out, typeClass)
+        varint(out, len(opcodes))
+        for opcode in opcodes:
+            varint(out, strings[opcode])
+        return bytes(out + body)
+
+    @staticmethod
+    def loads(data: bytes):
+        if data[:len(BinaryIR.magic)] != BinaryIR.magic or data[len(BinaryIR.magic)] != BinaryIR.version:
+            raise ValueError("Cannot load core URCL, it isn't in this version of the binary format.")
+        at = len(BinaryIR.magic) + 1
+
+        def varint():
+            nonlocal at
+            n = 0
+            shift = 0
+            while True:
+                byte = data[at]
+                at += 1
+                n |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    return n
+                shift += 7
+
+        strings: list[str] = []
+        for _ in range(varint()):
+            length = varint()
+            strings.append(data[at:at+length].decode())
+            at += length
+        types = BinaryIR.types
+        operands: list[Operand] = []
+        for _ in range(varint()):
+            tag = data[at]
+            at += 1
+            value = strings[varint()]
+            if tag & 0x80:
+                value = int(value)
+            word = varint()
+            operands.append(Operand(types[tag & 0x7F], value, word, None, strings[varint()]))
+        opcodes = [strings[varint()] for _ in range(varint())]
+
+        headers: dict[int, list[str]] = {}
+        for _ in range(varint()):
+            header = varint()
+            headers[header] = [strings[varint()] for _ in range(varint())]
+        regs = [strings[varint()] for _ in range(varint())]
+        code: list[Instruction] = []
+        for _ in range(varint()):
+            head = varint()
+            count = head >> 1 & 7
+            if count == 7:
+                count += varint()
+            labels = [strings[varint()] for _ in range(varint())] if head & 1 else []
+            code.append(Instruction(opcodes[head >> 4], [operands[varint()] for _ in range(count)], labels))
+        return Program(code, headers, regs)
+
+
+class CoreCache():
+    # Lowered core URCL in BinaryIR files named by a hash of everything that
+    # lowering depends on: the source, the tables, the word size and the
+    # options. Files are kept in the __pycache__ folder next to the source, and
+    # the oldest go once there are more than maxFiles.
+    maxFiles = 256
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        # What the last lookup did
+        self.hit = False
+
+    @staticmethod
+    def forFile(filename: str):
+        return CoreCache(os.path.join(os.path.dirname(os.path.abspath(filename)), "__pycache__", "core"))
+
+    @staticmethod
+    def key(files: list[str], options: list[str]):
+        # Files are hashed by content, each part length prefixed so parts can't
+        # run into each other
+        digest = hashlib.sha256(f"v{BinaryIR.version}".encode())
+        for filename in files:
+            with open(filename, "rb") as f:
+                data = f.read()
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        for option in options:
+            data = option.encode()
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.folder, f"{key}.urclir")
+
+    def get(self, key: str):
+        # The cached Program, or None
+        try:
+            with open(self.path(key), "rb") as f:
+                program = BinaryIR.loads(f.read())
+        except Exception:
+            # Missing, stale or unreadable, lower it again
+            self.hit = False
+            return None
+        self.hit = True
+        return program
+
+    def put(self, key: str, program: Program):
+        try:
+            data = BinaryIR.dumps(program)
+        except ValueError:
+            return
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            path = self.path(key)
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+            self.prune()
+        except OSError:
+            pass
+
+    def prune(self):
+        files = [os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith(".urclir")]
+        if len(files) <= CoreCache.maxFiles:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - CoreCache.maxFiles]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -13,7 +13,16 @@ class OpType(Enum):
     STACKPTR = auto()
     OTHER = auto()
 
+    # Members are singletons, and hashing them by name is slow for how often
+    # they're in dictionary keys
+    __hash__ = object.__hash__
+
 class Operand():
+    # Operands are values, nothing changes one after it's built. That lets
+    # instructions, case bodies and cached expansions share them freely;
+    # withValue() makes the copy to use instead of changing an operand.
+    __slots__ = ("type", "value", "word", "extra", "typeClass")
+
     # ======== Static variables ========
 
     # === Get symbol from type ===
@@ -51,7 +60,7 @@ class Operand():
         (lambda a: a[0] == "+",                               OpType.NEGATIVE, lambda a: f"-{a}"),
     ]
 
-    def __init__(self, type=OpType.NUMBER, value="", word=0, extra:dict[str]={}):
+    def __init__(self, type=OpType.NUMBER, value="", word=0, extra:"dict[str] | None"=None, typeClass:"str | None"=None):
         # Type: OpType.REGISTER, OpType.ADDRESS, OpType.LABEL, ...
         self.type = type
         self.value = value
@@ -59,7 +68,10 @@ class Operand():
         self.word = word
         # Any extra information that may need to be stored
         self.extra = extra
-        self.setTypeclass()
+        if typeClass is None:
+            self.setTypeclass()
+        else:
+            self.typeClass = typeClass
 
     # ======== Static methods ========
     @staticmethod
@@ -89,6 +101,10 @@ class Operand():
 
     # ======== Operand methods ========
 
+    def withValue(self, value, type=None):
+        # Same operand with a new value (and type), keeping the type class
+        return Operand(self.type if type is None else type, value, self.word, self.extra, self.typeClass)
+
     def setTypeclass(self):
         typeClass = "A"
         if self.type in [OpType.REGISTER]:
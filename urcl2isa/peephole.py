@@ -0,0 +1,327 @@
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Chain, Node
+from UTRX import Pattern, Translation
+
+class Rule():
+    # Replaces a window of instructions with shorter code. The window is URCL
+    # with @A, @B, ... standing for operands, the same letter meaning the same
+    # operand everywhere in the window, and literal operands like R0 or 1 that
+    # have to be just that. It can end in a label line like '.@B', which says
+    # the instruction after the window has that label, and is left alone.
+    # Parameters are the type classes of @A, @B, ... in order, in the case
+    # parameter language, where T is a register that's used nowhere but in the
+    # window. Every instruction of the window but the first has to be without
+    # labels, so nothing can jump into the middle of it.
+    __slots__ = ("name", "string", "window", "steps", "label", "letters", "patterns", "local", "checks", "width", "body")
+
+    def __init__(self, name: str, window: str, params: str, body: list[str]):
+        self.name = name
+        self.string = f"{window.strip()} :: {params.strip()}".strip()
+        self.window: list[tuple[str, tuple]] = []
+        self.label: "str | None" = None
+        letters: list[str] = []
+        for part in window.split(";"):
+            words = part.split()
+            if not words:
+                continue
+            if self.label is not None:
+                raise ValueError(f"Cannot parse rule '{self.string}', the label line has to be last.")
+            if len(words) == 1 and words[0].startswith(".@"):
+                self.label = Rule.letter(words[0][1:], self.string)
+                continue
+            slots = tuple(Rule.slot(word, self.string) for word in words[1:])
+            for kind,value in slots:
+                if kind == "ph" and value not in letters:
+                    letters.append(value)
+            self.window.append((words[0], slots))
+        if not self.window:
+            raise ValueError(f"Cannot parse rule '{self.string}', it has no instructions.")
+        if self.label is not None and self.label not in letters:
+            letters.append(self.label)
+        self.letters = sorted(letters)
+        params = params.split()
+        if len(params) != len(self.letters):
+            raise ValueError(f"Cannot parse rule '{self.string}', it needs a parameter for each of {' '.join('@' + l for l in self.letters)}.")
+        for param in params:
+            if param in ["==", "~~", "<>", "!=", "!~"]:
+                raise ValueError(f"Cannot parse rule '{self.string}', the same letter already means the same operand.")
+        self.local = tuple("T" in param for param in params)
+        self.patterns = tuple(Pattern(param.replace("T", "R")) for param in params)
+        # Matching goes by steps of (opcode, operand count, literals by
+        # position, letters by position), then the letters that have to be
+        # local and all the parameters
+        self.steps = tuple((opcode, len(slots),
+                            tuple((i, value) for i,(kind,value) in enumerate(slots) if kind == "lit"),
+                            tuple((i, value) for i,(kind,value) in enumerate(slots) if kind == "ph"))
+                           for opcode,slots in self.window)
+        self.checks = tuple(zip(self.letters, self.patterns, self.local))
+        self.width = sum(len(slots) for _,slots in self.window)
+        self.body: list[tuple[str, tuple]] = []
+        for line in body:
+            words = line.split()
+            if not words:
+                continue
+            slots = tuple(Rule.slot(word, self.string) for word in words[1:])
+            for kind,value in slots:
+                if kind == "ph" and value not in self.letters:
+                    raise ValueError(f"Cannot parse rule '{self.string}', @{value} isn't in the window.")
+            self.body.append((words[0], slots))
+        if len(self.body) >= len(self.window):
+            raise ValueError(f"Cannot parse rule '{self.string}', it has to make code shorter.")
+
+    @staticmethod
+    def letter(word: str, string: str):
+        if len(word) != 2 or word[0] != "@" or not "A" <= word[1] <= "Z":
+            raise ValueError(f"Cannot parse rule '{string}', '{word}' isn't a placeholder.")
+        return word[1]
+
+    @staticmethod
+    def slot(word: str, string: str):
+        if word.startswith("@"):
+            return ("ph", Rule.letter(word, string))
+        opr = Operand.parse(word)
+        if opr.type == OpType.REGISTER and opr.value != "0":
+            raise ValueError(f"Cannot parse rule '{string}', R0 is the only register it can name.")
+        return ("lit", opr)
+
+    def match(self, node: Node, uses: dict[str, int]):
+        # The operands bound to each letter and the node after the window, or
+        # None if the window doesn't start at node
+        bound: dict[str, Operand] = {}
+        first = node
+        for w,(opcode,arity,literals,places) in enumerate(self.steps):
+            if node is None:
+                return None
+            ins = node.ins
+            operands = ins.operands
+            if ins.opcode != opcode or len(operands) != arity or (w and ins.labels):
+                return None
+            for i,value in literals:
+                if not Rule.same(value, operands[i]):
+                    return None
+            for i,letter in places:
+                opr = operands[i]
+                other = bound.get(letter)
+                if other is None:
+                    bound[letter] = opr
+                elif other is not opr and not Rule.same(other, opr):
+                    return None
+            node = node.next
+        if self.label is not None:
+            target = bound.get(self.label)
+            if node is None or target is None or target.type != OpType.LABEL:
+                return None
+            if not any(label.lstrip(".") == target.value for label in node.ins.labels):
+                return None
+        for letter,pattern,local in self.checks:
+            opr = bound[letter]
+            if not pattern.match(opr):
+                return None
+            if local:
+                if opr.type != OpType.REGISTER or opr.value == "0" or uses.get(opr.value, 0) > self.width:
+                    return None
+                if self.count(first, opr.value) != uses[opr.value]:
+                    return None
+        return bound, node
+
+    def count(self, node: Node, register: str):
+        # Uses of a register in the window starting at node
+        count = 0
+        for _ in self.steps:
+            for opr in node.ins.operands:
+                if opr.type == OpType.REGISTER and opr.value == register:
+                    count += 1
+            node = node.next
+        return count
+
+    def instantiate(self, bound: dict[str, Operand]):
+        code: list[Instruction] = []
+        for opcode,slots in self.body:
+            code.append(Instruction(opcode, [bound[value] if kind == "ph" else value for kind,value in slots]))
+        return code
+
+    @staticmethod
+    def same(a: Operand, b: Operand):
+        return a.type == b.type and (a.value == b.value or str(a.value) == str(b.value)) and a.word == b.word
+
+
+class Peephole():
+    # Rewrites core URCL with the rules of a file to a fixpoint in one pass. A
+    # rewrite can only make windows match that overlap the new code, or that
+    # use a register it took uses of away, so those are tried again from a
+    # worklist before the pass moves on. Every rewrite removes an instruction
+    # and queues a bounded number of others, so the pass is linear.
+    def __init__(self, rules: list[Rule]):
+        self.rules = rules
+        self.index: dict[str, list[Rule]] = {}
+        for rule in rules:
+            self.index.setdefault(rule.window[0][0], []).append(rule)
+        self.longest = max((len(rule.window) for rule in rules), default=1)
+        # A register used more often than any window has operands can't be
+        # local to a window
+        self.widest = max((rule.width for rule in rules), default=0)
+        # What the last run did
+        self.before = 0
+        self.after = 0
+        self.hits: dict[str, int] = {}
+
+    def run(self, program: Program):
+        self.before = len(program.code)
+        self.hits = {}
+        program.link()
+        chain: Chain = program.code
+        # Uses of every register, and the nodes that used it at some point
+        self.uses: dict[str, int] = {}
+        self.users: dict[str, list[Node]] = {}
+        node = chain.head
+        while node is not None:
+            self.track(node, 1)
+            node = node.next
+        queue: list[Node] = []
+        node = chain.head
+        while node is not None or queue:
+            if queue:
+                at = queue.pop()
+                if at.ins is not None:
+                    after = self.attempt(chain, at, queue)
+                    # The rewrite can take the scan's place away
+                    if after is not False and node is not None and node.ins is None:
+                        node = after
+                continue
+            after = self.attempt(chain, node, queue)
+            node = node.next if after is False else after
+        program.flatten()
+        self.after = len(program.code)
+        # Rewrites can take every use of a register away
+        program.regs = [reg for reg in program.regs if self.uses.get(reg)]
+        program.regSet = set(program.regs)
+        return program
+
+    def attempt(self, chain: Chain, node: Node, queue: list[Node]):
+        # Tries every rule at node. Returns the node after what was rewritten,
+        # or False if nothing matched.
+        for rule in self.index.get(node.ins.opcode, ()):
+            match = rule.match(node, self.uses)
+            if match is None:
+                continue
+            bound, after = match
+            code = rule.instantiate(bound)
+            labels = node.ins.labels
+            if not code and labels and after is None:
+                # Nowhere to put the labels
+                continue
+            self.hits[rule.string] = self.hits.get(rule.string, 0) + 1
+            self.rewrite(chain, node, after, code, labels, queue)
+            return after
+        return False
+
+    def rewrite(self, chain: Chain, node: Node, after: "Node | None", code: list[Instruction], labels: list[str], queue: list[Node]):
+        # Puts code in place of node up to after
+        before = node.prev
+        if code:
+            code[0].labels = list(labels)
+        elif labels:
+            after.ins.labels[:0] = labels
+        touched: set[str] = set()
+        while True:
+            self.track(node, -1)
+            for opr in node.ins.operands:
+                if opr.type == OpType.REGISTER:
+                    touched.add(opr.value)
+            following = node.next
+            if following is after:
+                chain.splice(node, Chain(code))
+            else:
+                chain.splice(node, Chain())
+            node.ins = None
+            if following is after:
+                break
+            node = following
+        new = before.next if before is not None else chain.head
+        while new is not after:
+            self.track(new, 1)
+            new = new.next
+        # Windows over the new code, or over where the old code was
+        self.queueAround(chain, before, after, queue)
+        for reg in touched:
+            if self.uses.get(reg, 0) <= self.widest:
+                users = [user for user in self.users.get(reg, ()) if user.ins is not None]
+                self.users[reg] = users
+                for user in users:
+                    self.queueAround(chain, user.prev, user.next, queue)
+
+    def queueAround(self, chain: Chain, before: "Node | None", end: "Node | None", queue: list[Node]):
+        # Queues every node from after before up to end, and every node before
+        # that a window reaching them could start at
+        node = before.next if before is not None else chain.head
+        while node is not end:
+            queue.append(node)
+            node = node.next
+        for _ in range(self.longest - 1):
+            if before is None:
+                break
+            queue.append(before)
+            before = before.prev
+
+    def track(self, node: Node, step: int):
+        uses = self.uses
+        for opr in node.ins.operands:
+            if opr.type == OpType.REGISTER:
+                value = opr.value
+                uses[value] = uses.get(value, 0) + step
+                if step > 0:
+                    users = self.users.get(value)
+                    if users is None:
+                        self.users[value] = [node]
+                    else:
+                        users.append(node)
+
+    def toString(self):
+        removed = self.before - self.after
+        share = removed / self.before if self.before else 0
+        out = f"Peephole: {self.before} -> {self.after} core instructions, {removed} removed ({share:.1%})"
+        for rule,hits in sorted(self.hits.items(), key=lambda a: -a[1]):
+            out += f"\n{hits:>10}  {rule}"
+        return out
+
+    @staticmethod
+    def parseFile(filename: str):
+        # Rules are written like UTRX cases, each under an optional description:
+        #   /* NAME
+        #   What the rules below do
+        #   */
+        #   NOR @A @B R0; NOR @A @A R0 :: R R {
+        #       ADD @A @B R0
+        #   }
+        rules: list[Rule] = []
+        name = ""
+        header = None
+        body: list[str] = []
+        description = False
+        for n,line in enumerate(Translation.readFile(filename)):
+            stripped = line.strip()
+            if description:
+                description = not stripped.startswith("*/")
+                continue
+            if header is None and stripped.startswith("/*"):
+                words = stripped.split()
+                name = words[1] if len(words) > 1 else ""
+                description = True
+                continue
+            if header is not None:
+                if stripped == "}":
+                    try:
+                        rules.append(Rule(name, *header, body))
+                    except ValueError as e:
+                        raise ValueError(f"{filename}:{n+1}: {e}")
+                    header = None
+                    body = []
+                else:
+                    body.append(stripped)
+            elif " :: " in stripped and stripped.endswith("{"):
+                window, params = stripped[:-1].split(" :: ")
+                header = (window, params)
+            elif stripped.startswith("//") or not stripped:
+                continue
+        return Peephole(rules)
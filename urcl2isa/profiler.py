@@ -0,0 +1,76 @@
+from typing import TYPE_CHECKING
+import json
+if TYPE_CHECKING:
+    from UTRX import Translation, Case
+    from cache import ExpansionCache
+
+class MatchStats():
+    # How one UTRX table gets used. A Translator only records into this when
+    # it's given one, otherwise the cost is a None check per instruction.
+    def __init__(self):
+        # Instructions looked at per opcode, and how many were matched to a case
+        # (expansion cache hits skip matching altogether)
+        self.visits: dict[str, int] = {}
+        self.expansions: dict[str, int] = {}
+        self.unmatched: dict[str, int] = {}
+        # How many cases had to be tried per match, and which ones matched
+        self.tried: dict[int, int] = {}
+        self.hits: dict[str, int] = {}
+        # Instructions by how deeply nested in expansions they were
+        self.depths: dict[int, int] = {}
+        self.cache: "ExpansionCache | None" = None
+
+    def visit(self, opcode: str, depth: int):
+        self.visits[opcode] = self.visits.get(opcode, 0) + 1
+        self.depths[depth] = self.depths.get(depth, 0) + 1
+
+    def match(self, translation: "Translation", case: "Case | None", tried: int):
+        self.tried[tried] = self.tried.get(tried, 0) + 1
+        if case is None:
+            self.unmatched[translation.opcode] = self.unmatched.get(translation.opcode, 0) + 1
+            return
+        self.expansions[translation.opcode] = self.expansions.get(translation.opcode, 0) + 1
+        name = f"{translation.opcode} :: {case.string.strip()}"
+        self.hits[name] = self.hits.get(name, 0) + 1
+
+    def toDict(self):
+        out = {
+            "visits": self.visits,
+            "expansions": self.expansions,
+            "unmatched": self.unmatched,
+            "casesTried": {str(k): v for k,v in sorted(self.tried.items())},
+            "caseHits": dict(sorted(self.hits.items(), key=lambda a: -a[1])),
+            "depths": {str(k): v for k,v in sorted(self.depths.items())},
+        }
+        if self.cache is not None:
+            out["cache"] = {"hits": self.cache.hits, "misses": self.cache.misses, "evictions": self.cache.evictions}
+        return out
+
+
+class Profiler():
+    # Wall time and size before and after each stage of a translation, and
+    # the match statistics of every table involved
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+        self.tables: dict[str, MatchStats] = {}
+
+    def table(self, filename: str):
+        stats = self.tables.get(filename)
+        if stats is None:
+            stats = MatchStats()
+            self.tables[filename] = stats
+        return stats
+
+    def stage(self, name: str, seconds: float, sizeIn: "int | None"=None, sizeOut: "int | None"=None):
+        stage = {"seconds": seconds}
+        if sizeIn is not None and sizeOut is not None:
+            stage["in"] = sizeIn
+            stage["out"] = sizeOut
+            stage["growth"] = sizeOut / sizeIn if sizeIn else None
+        self.stages[name] = stage
+
+    def toJSON(self, **info):
+        out = dict(info)
+        out["stages"] = self.stages
+        out["tables"] = {name: stats.toDict() for name,stats in self.tables.items()}
+        return json.dumps(out, indent=2)
@@ -1,6 +1,7 @@
 from operand import Operand, OpType
 from instruction import Instruction
 from enum import Enum
+from itertools import islice
 from colorama import init
 
 init(autoreset=True)
@@ -16,74 +17,254 @@ MINSTACK
 
 Header = Enum("Header", " ".join(headers))
 
+class Node():
+    __slots__ = ("ins", "prev", "next")
+
+    def __init__(self, ins: Instruction):
+        self.ins = ins
+        self.prev: "Node | None" = None
+        self.next: "Node | None" = None
+
+
+class Chain():
+    # Doubly linked list of instructions. Splicing a chain in place of a node is
+    # O(1) and nodes stay valid while the chain around them changes, so they
+    # make stable cursors for passes that rewrite code as they go.
+    __slots__ = ("head", "tail", "length")
+
+    def __init__(self, code: list[Instruction]=()):
+        self.head: "Node | None" = None
+        self.tail: "Node | None" = None
+        self.length = 0
+        for ins in code:
+            self.append(ins)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        node = self.head
+        while node is not None:
+            yield node.ins
+            node = node.next
+
+    def append(self, ins: Instruction):
+        node = Node(ins)
+        node.prev = self.tail
+        if self.tail is None:
+            self.head = node
+        else:
+            self.tail.next = node
+        self.tail = node
+        self.length += 1
+        return node
+
+    def splice(self, node: Node, chain: "Chain"):
+        # Replaces node with every node of chain, which is left empty. Returns the
+        # first spliced node, or the one after node if chain was empty.
+        after = node.next
+        if chain.head is None:
+            first = after
+            if node.prev is None:
+                self.head = after
+            else:
+                node.prev.next = after
+            if after is None:
+                self.tail = node.prev
+            else:
+                after.prev = node.prev
+        else:
+            first = chain.head
+            first.prev = node.prev
+            if node.prev is None:
+                self.head = first
+            else:
+                node.prev.next = first
+            chain.tail.next = after
+            if after is None:
+                self.tail = chain.tail
+            else:
+                after.prev = chain.tail
+        self.length += chain.length - 1
+        chain.head = chain.tail = None
+        chain.length = 0
+        return first
+
+    def toList(self):
+        return list(self)
+
+
+class Registers():
+    # Interns register names to integer IDs and hands out fresh temporaries in
+    # O(1). ID 0 is always R0. Sub-programs share their parent's Registers, so
+    # an ID means the same register everywhere in a translation.
+    __slots__ = ("ids", "count")
+
+    def __init__(self):
+        self.ids: dict[str, int] = {"0": 0}
+        self.count = 1
+
+    def intern(self, name: str):
+        id = self.ids.get(name)
+        if id is None:
+            id = self.count
+            self.ids[name] = id
+            self.count += 1
+        return id
+
+    def fresh(self):
+        self.count += 1
+        return self.count - 1
+
+
+class Numbering():
+    # Program.makeRegsNumeric one instruction at a time, for passes that don't
+    # have the whole program. Temporaries only live as long as the expansion of
+    # one source instruction, so their numbers are forgotten after it.
+    __slots__ = ("named", "numbers", "count", "temps", "numbered")
+
+    def __init__(self):
+        self.named: set[int] = set()
+        # Numbers of the program's own registers, in order of first use
+        self.numbers: dict[int, str] = {}
+        self.count = 0
+        self.temps: dict[int, str] = {}
+        self.numbered: dict[tuple, Operand] = {}
+
+    def begin(self, source: Instruction):
+        # Starts on the expansion of another source instruction
+        for opr in source.operands:
+            if opr.type == OpType.REGISTER:
+                self.named.add(opr.value)
+        self.temps = {}
+        self.numbered = {}
+
+    def rewind(self, names: int, count: int):
+        # Back to when the first names of the program's own registers had been
+        # numbered and count numbers were handed out
+        self.numbers = dict(islice(self.numbers.items(), names))
+        self.count = count
+
+    def number(self, ins: Instruction):
+        for o,opr in enumerate(ins.operands):
+            if opr.type != OpType.REGISTER:
+                continue
+            key = (opr.value, opr.word, opr.typeClass)
+            new = self.numbered.get(key)
+            if new is None:
+                if opr.value == 0:
+                    number = "0"
+                else:
+                    numbers = self.numbers if opr.value in self.named else self.temps
+                    number = numbers.get(opr.value)
+                    if number is None:
+                        self.count += 1
+                        number = str(self.count)
+                        numbers[opr.value] = number
+                new = opr.withValue(number)
+                self.numbered[key] = new
+            ins.operands[o] = new
+
+
 class Program():
-    def __init__(self, code:list[Instruction]=[], headers:dict[int, str]={}, regs:list[str]=[]):
-        self.code = code
-        self.headers = headers
-        self.regs: list[str] = regs
+    __slots__ = ("code", "headers", "regs", "regSet", "registers", "uid")
+
+    def __init__(self, code:"list[Instruction] | None"=None, headers:"dict[int, str] | None"=None, regs:list[int]=(), registers: "Registers | None"=None):
+        # code is a list, or a Chain while the program is being expanded
+        self.code = [] if code is None else code
+        self.headers = {} if headers is None else headers
+        # IDs of the registers the program uses, numbers once they're numeric
+        self.regs: list[int] = list(regs)
+        # Mirrors regs for constant time membership tests
+        self.regSet: set[int] = set(regs)
+        self.registers = Registers() if registers is None else registers
         self.uid: int = 0
 
-    def makeRegsNumeric(self):
-        self.regs = []
-        for i,ins in enumerate(self.code):
-            for o,opr in enumerate(ins.operands):
-                if opr.type == OpType.REGISTER and opr.value != "0":
-                    if opr.value not in self.regs:
-                        self.regs.append(opr.value)
-                    self.code[i].operands[o].value = str(1+self.regs.index(opr.value))
-        for r,reg in enumerate(self.regs):
-            self.regs[r] = str(r+1)
+    def link(self):
+        self.code = Chain(self.code)
 
-    def primeRegs(self):
-        for r,reg in enumerate(self.regs):
-            if reg != "0":
-                self.rename(reg, reg+"'")
-            self.regs[r] = reg+"'"
+    def flatten(self):
+        self.code = self.code.toList()
 
+    def addRegs(self, regs: list[int]):
+        for reg in regs:
+            if reg not in self.regSet:
+                self.regSet.add(reg)
+                self.regs.append(reg)
+
+    def makeRegsNumeric(self):
+        # Numbers registers 1, 2, ... in order of first use, R0 stays 0. Every
+        # use of a register with the same word and type class ends up sharing one
+        # numbered operand.
+        numbers: dict = {}
+        numbered: dict[tuple, Operand] = {}
+        for ins in self.code:
+            for o,opr in enumerate(ins.operands):
+                if opr.type != OpType.REGISTER:
+                    continue
+                key = (opr.value, opr.word, opr.typeClass)
+                new = numbered.get(key)
+                if new is None:
+                    if opr.value == 0 or opr.value == "0":
+                        number = "0"
+                    else:
+                        number = numbers.get(opr.value)
+                        if number is None:
+                            number = str(len(numbers)+1)
+                            numbers[opr.value] = number
+                    new = opr.withValue(number)
+                    numbered[key] = new
+                ins.operands[o] = new
+        self.regs = list(numbers.values())
+        self.regSet = set(self.regs)
 
     def uniqueLabels(self, uid=0):
         labels = {}
         # First pass update definitions
-        for i,ins in enumerate(self.code):
+        for ins in self.code:
             for l,label in enumerate(ins.labels):
                 labels[label] = f"{label}_{uid}"
-                self.code[i].labels[l] = labels[label]
+                ins.labels[l] = labels[label]
                 uid += 1
         # Second pass update references
-        for i,ins in enumerate(self.code):
+        for ins in self.code:
             for o,opr in enumerate(ins.operands):
                 if opr.type == OpType.LABEL and labels.get(opr.value) is not None:
-                    self.code[i].operands[o].value = labels[opr.value]
+                    ins.operands[o] = opr.withValue(labels[opr.value])
         return uid
 
     def insertSub(self, program, index=-1):
         self.uid = program.uniqueLabels(self.uid)
         self.replace(program, index)
 
+    def spliceSub(self, program, node: Node):
+        # insertSub for a linked program: program.code has to be a Chain, and
+        # replaces node in O(1)
+        self.uid = program.uniqueLabels(self.uid)
+        labels = node.ins.labels
+        first = self.code.splice(node, program.code)
+        self.addRegs(program.regs)
+        if first is not None:
+            first.ins.labels += labels
+
     def replace(self, program, index=-1):
         labels = self.code[index].labels
         self.code[index:index+1] = program.code
-        self.regs = list(set(self.regs + program.regs))
+        self.addRegs(program.regs)
         self.code[index].labels += labels
 
     def insert(self, program, index=-1):
         self.code[index:index] = program.code
-        self.regs = list(set(self.regs + program.regs))
+        self.addRegs(program.regs)
 
     def rename(self, oldname: str, newname: str, type=OpType.REGISTER):
         for i,ins in enumerate(self.code):
             for o,opr in enumerate(ins.operands):
                 if opr.type == type and opr.value == oldname:
-                    self.code[i].operands[o].value = newname
+                    self.code[i].operands[o] = opr.withValue(newname)
         if opr.type == OpType.REGISTER:
             self.regs[self.regs.index(oldname)] = newname
-
-    def unpackPlaceholders(self):
-        for i,ins in enumerate(self.code):
-            for o,opr in enumerate(ins.operands):
-                if opr.type == OpType.OTHER:
-                    if opr.value.isalpha() and len(opr.value) == 1:
-                        self.code[i].operands[o] = opr.extra[opr.value]
+            self.regSet = set(self.regs)
 
     def relativesToLabels(self):
         for i,ins in enumerate(self.code):
@@ -94,13 +275,34 @@ class Program():
                     self.uid += 1
 
     @staticmethod
-    # The program is a list of strings
-    def parse(program: list[str], wordSize: int=8):
+    # The program is a list of strings, constants are left alone if wordSize is None
+    def parse(program: list[str], wordSize: "int | None"=8):
         headers: dict[int, str] = {}
-        code: list[Instruction] = []
-        regs: list[str] = []
+        registers = Registers()
+        code = list(Program.tokenize(program, wordSize, registers, headers))
+        regs: list[int] = []
+        seen: set[int] = set()
+        for ins in code:
+            for operand in ins.operands:
+                if operand.type == OpType.REGISTER and operand.value not in seen:
+                    seen.add(operand.value)
+                    regs.append(operand.value)
+        return Program(code, headers, regs, registers)
+
+    @staticmethod
+    # Yields instructions one at a time from any iterable of lines, such as an
+    # open file. Headers go into headers and register names are interned into
+    # registers as they're read. The index of the line each instruction came
+    # from is appended to positions if it's given.
+    def tokenize(lines, wordSize: "int | None"=8, registers: "Registers | None"=None, headers: "dict[int, str] | None"=None, positions: "list[int] | None"=None):
+        if registers is None:
+            registers = Registers()
+        if headers is None:
+            headers = {}
         skip = False
-        for line in program:
+        # Held back one line, a NOP only passes its labels on to what follows it
+        pending: "Instruction | None" = None
+        for n,line in enumerate(lines):
             if "*/" in line:
                 skip = False
                 continue
@@ -109,8 +311,6 @@ class Program():
             elif "/*" in line:
                 skip = True
                 continue
-            while "  " in line:
-                line = line.replace("  "," ")
             line = line.split("//")[0]
             header = Program.parseHeader(line)
             if header is not None:
@@ -119,43 +319,53 @@ class Program():
             ins = Instruction.parse(line)
             if ins is None:
                 continue
-            if len(code) > 0:
-                if code[-1].opcode == "NOP":
-                    if code[-1].labels is not None:
-                        ins.labels += code[-1].labels
-                    code = code[:-1]
+            if pending is not None:
+                if pending.opcode == "NOP":
+                    ins.labels += pending.labels
+                else:
+                    if positions is not None:
+                        positions.append(position)
+                    yield pending
             for o,operand in enumerate(ins.operands):
                 if operand.type == OpType.REGISTER:
-                    if operand.value not in regs:
-                        regs.append(operand.value)
-                if operand.type == OpType.OTHER:
-                    v = operand.value
-                    if v == "MAX":
-                        v = 2**(wordSize)-1
-                    elif v == "SMAX":
-                        v = 2**(wordSize)-1 - 2**(wordSize-1)
-                    elif v == "MSB":
-                        v = 2**(wordSize-1)
-                    elif v == "SMSB":
-                        v = 2**(wordSize-2)
-                    elif v == "UHALF":
-                        v = 2**(wordSize) - 2**(wordSize/2)
-                    elif v == "LHALF":
-                        v = 2**(wordSize/2)-1
-                    elif v == "BITS":
-                        v = wordSize
-                    else:
-                        continue
-                    ins.operands[o].value = int(v)
-                    ins.operands[o].type = OpType.NUMBER
-            code.append(ins)
-        return Program(code, headers, regs)
+                    # The type class stays the one worked out from the name
+                    ins.operands[o] = operand.withValue(registers.intern(operand.value))
+                elif operand.type == OpType.OTHER and wordSize is not None:
+                    v = Program.constant(operand.value, wordSize)
+                    if v is not None:
+                        ins.operands[o] = operand.withValue(v, OpType.NUMBER)
+            pending = ins
+            position = n
+        if pending is not None:
+            if positions is not None:
+                positions.append(position)
+            yield pending
+
+    @staticmethod
+    # Value of a word size dependent constant like @MAX, None for other names
+    def constant(name: str, wordSize: int=8):
+        if name == "MAX":
+            v = 2**(wordSize)-1
+        elif name == "SMAX":
+            v = 2**(wordSize)-1 - 2**(wordSize-1)
+        elif name == "MSB":
+            v = 2**(wordSize-1)
+        elif name == "SMSB":
+            v = 2**(wordSize-2)
+        elif name == "UHALF":
+            v = 2**(wordSize) - 2**(wordSize/2)
+        elif name == "LHALF":
+            v = 2**(wordSize/2)-1
+        elif name == "BITS":
+            v = wordSize
+        else:
+            return None
+        return int(v)
 
     @staticmethod
     def parseFile(filename: str):
         with open(filename, "r") as f:
-            lines = [l.strip() for l in f]
-        return Program.parse(lines)
+            return Program.parse(f)
 
     @staticmethod
     def parseHeader(line: str):
@@ -167,6 +377,30 @@ class Program():
         except:
             return None
 
+    @staticmethod
+    # Only the headers of a file, without parsing any code
+    def parseHeaders(lines):
+        out: dict[int, list[str]] = {}
+        skip = False
+        for line in lines:
+            if "*/" in line:
+                skip = False
+            elif not skip and "/*" in line:
+                skip = True
+            elif not skip:
+                header = Program.parseHeader(line.split("//")[0])
+                if header is not None:
+                    out[header[0]] = header[1]
+        return out
+
+    @staticmethod
+    # The word size a BITS header gives, default if there isn't one
+    def wordSize(headers: dict[int, list[str]], default: int=8):
+        bits = headers.get(Header.BITS.value)
+        if bits and bits[-1].isnumeric():
+            return int(bits[-1])
+        return default
+
     def toString(self, indent=0):
         return "\n".join(l.toString(indent=indent) for l in self.code)
     
@@ -0,0 +1,192 @@
+from operand import OpType
+from instruction import Instruction
+from program import Registers
+from translator import Translator
+from cache import ExpansionCache
+from UTRX import Case
+
+class Selector():
+    # Decides for every instruction whether the target translates it as it is,
+    # or it gets expanded with the URCL tables, whichever runs faster (speed) or
+    # takes fewer words (size). An expansion costs what its code costs with
+    # each of its instructions lowered the cheapest way in turn, so costs are
+    # worked out bottom up over the expansion tree, once per instruction
+    # signature. A target case costs what its header says, 'LLOD :: R R R | 2 1 {'
+    # being 2 cycles and 1 word, or else a cycle for every line that takes up
+    # space and the size of its lines from the SIZES block. Instructions that
+    # can't be lowered at all cost infinitely much.
+    # Relative jumps count instructions of the finished code, so whatever one
+    # could jump across is lowered all the way to core URCL like without a
+    # selector: in a program, the instructions that lowered like that would be
+    # in its reach, in an expansion, all of it.
+    goals = ["speed", "size"]
+    infinite = (float("inf"), float("inf"))
+
+    def __init__(self, translator: Translator, translatorISA: Translator, goal: str="speed"):
+        if goal not in Selector.goals:
+            raise ValueError(f"Cannot optimise for '{goal}', expected one of {', '.join(Selector.goals)}.")
+        self.translator = translator
+        self.translatorISA = translatorISA
+        self.goal = goal
+        # Instructions cost the same when they'd match the same cases of either
+        # table, which is what expansion cache signatures tell apart
+        self.signatures = ExpansionCache(0, translator.cache.exact or translatorISA.cache.exact)
+        # By signature: (cheapest (cycles, size), whether that's the target's
+        # own case, (cycles, size) lowered through core URCL, instructions
+        # lowered through core URCL)
+        self.costs: dict[tuple, tuple] = {}
+        # Instructions of the program being translated that relative jumps
+        # could jump across
+        self.pinned: set[Instruction] = set()
+        self.caseCosts: dict[int, tuple[int, int]] = {}
+        # Temporaries of expansions that are only costed
+        self.registers = Registers()
+        # Estimates for the last program, leaving out the instructions that
+        # can't be lowered
+        self.chosen = (0, 0)
+        self.core = (0, 0)
+        self.unlowered = 0
+
+    def rank(self, cost: tuple):
+        return cost if self.goal == "speed" else (cost[1], cost[0])
+
+    def keep(self, ins: Instruction):
+        # Whether ins goes to the target as it is
+        return self.entry(ins)[1]
+
+    def selects(self, ins: Instruction):
+        # Whether the selector gets a say in how ins is lowered
+        return ins not in self.pinned
+
+    def pin(self, code: list[Instruction]):
+        # Pins every instruction that a relative jump of code could jump across,
+        # measured in core URCL instructions, and the jump itself
+        self.pinned = set()
+        lengths = None
+        for i,ins in enumerate(code):
+            for opr in ins.operands:
+                if opr.type != OpType.RELATIVE:
+                    continue
+                if lengths is None:
+                    lengths = [self.entry(other)[3] for other in code]
+                self.pinned.add(ins)
+                offset = int(opr.value)
+                if offset >= 0:
+                    # The jump can be anywhere in the code of ins
+                    reach = lengths[i] - 1 + offset
+                    total = lengths[i]
+                    j = i + 1
+                    while j < len(code) and total <= reach:
+                        self.pinned.add(code[j])
+                        total += lengths[j]
+                        j += 1
+                else:
+                    total = 0
+                    j = i - 1
+                    while j >= 0 and total < -offset:
+                        self.pinned.add(code[j])
+                        total += lengths[j]
+                        j -= 1
+
+    def entry(self, ins: Instruction):
+        key = self.signatures.signature(ins)
+        entry = self.costs.get(key)
+        if entry is not None:
+            return entry
+        # An expansion that leads back to the same instruction never ends
+        self.costs[key] = (Selector.infinite, False, Selector.infinite, 1)
+        native = self.native(ins)
+        code = self.expand(ins)
+        if code is None:
+            entry = (native, False, native, 1)
+        else:
+            free = Selector.free(code)
+            best = [0, 0]
+            core = [0, 0]
+            length = 0
+            for sub in code:
+                subEntry = self.entry(sub)
+                for i in range(2):
+                    best[i] += subEntry[0 if free else 2][i]
+                    core[i] += subEntry[2][i]
+                length += subEntry[3]
+            best = tuple(best)
+            core = tuple(core)
+            # Ties go to the expansion, as without a selector
+            if self.rank(native) < self.rank(best):
+                entry = (native, True, core, length)
+            else:
+                entry = (best, False, core, length)
+        self.costs[key] = entry
+        return entry
+
+    def native(self, ins: Instruction):
+        translation = self.translatorISA.translations.get(ins.opcode)
+        if translation is None:
+            return Selector.infinite
+        # Matching can swap operands around, so it gets its own list
+        case = Instruction(ins.opcode, list(ins.operands)).matchCase(translation)
+        if case is None:
+            return Selector.infinite
+        return self.caseCost(case)
+
+    def caseCost(self, case: Case):
+        if case.cost is not None:
+            return case.cost
+        cost = self.caseCosts.get(id(case))
+        if cost is None:
+            sizes = []
+            for head in case.output.heads:
+                if head:
+                    spec = self.translatorISA.sizes.get(head)
+                    # Lines that can be short are costed long
+                    sizes.append(spec[0] if len(spec) == 1 else spec[1])
+            cost = (sum(1 for size in sizes if size), sum(sizes))
+            self.caseCosts[id(case)] = cost
+        return cost
+
+    def expand(self, ins: Instruction):
+        # The code ins expands to, or None if it doesn't
+        translation = self.translator.translations.get(ins.opcode)
+        if translation is None:
+            return None
+        copy = Instruction(ins.opcode, list(ins.operands))
+        case = copy.matchCase(translation)
+        if case is None:
+            return None
+        return Translator.body(case).instantiate(copy.operands, self.registers).code
+
+    @staticmethod
+    def free(code):
+        # Whether code has no relative jumps whose distance lowering could change
+        for ins in code:
+            for opr in ins.operands:
+                if opr.type == OpType.RELATIVE:
+                    return False
+        return True
+
+    def estimate(self, code: list[Instruction]):
+        # What the code costs lowered as selected, and lowered through core URCL
+        self.pin(code)
+        chosen = [0, 0]
+        core = [0, 0]
+        self.unlowered = 0
+        for ins in code:
+            entry = self.entry(ins)
+            if entry[2] == Selector.infinite:
+                self.unlowered += 1
+                continue
+            which = 0 if self.selects(ins) else 2
+            for i in range(2):
+                chosen[i] += entry[which][i]
+                core[i] += entry[2][i]
+        self.chosen = tuple(chosen)
+        self.core = tuple(core)
+        return self.chosen, self.core
+
+    def toString(self):
+        kept = sum(1 for entry in self.costs.values() if entry[1])
+        out = f"Optimised for {self.goal}: estimated {self.chosen[0]} cycles and {self.chosen[1]} words, against {self.core[0]} cycles and {self.core[1]} words through core URCL, {kept} kinds of instruction kept for the target"
+        if self.unlowered:
+            out += f", {self.unlowered} instructions left out that can't be lowered"
+        return out
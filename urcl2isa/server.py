@@ -0,0 +1,166 @@
+from program import Program
+from translator import Translator
+from timeit import default_timer as timer
+import asyncio
+import json
+import io
+import os
+import stat
+import sys
+
+class Server():
+    # Keeps translators loaded between requests, so translating a file costs
+    # none of the startup. Requests and replies are JSON, one per line, over
+    # stdin/stdout or a Unix socket. A request is
+    #   {"id": any, "target": "isa/x.utrx", "file": "prog/y.urcl"}
+    # with "source" (the URCL text) instead of "file" if it's not in a file, and
+    # "output" for a file to write the ISA code to instead of sending it back.
+    # The reply has the same id, and either "output" (unless it was written to
+    # a file) with instruction counts and the time it took, or "error".
+    # Requests are read and answered concurrently, but translators aren't safe
+    # to share, so only one translates at a time and in a thread of its own,
+    # leaving the event loop to take in more requests meanwhile. A table is
+    # loaded again when its file changes, from the compiled table cache when
+    # that's up to date.
+    def __init__(self, URCLtranslations: str, target: "str | None"=None, cacheSize: int=4096, cached: bool=True):
+        self.URCLtranslations = URCLtranslations
+        self.target = target
+        self.cacheSize = cacheSize
+        self.cached = cached
+        # Translators by their table's path, with the (mtime, size) they were
+        # loaded at
+        self.tables: dict[str, tuple[tuple[int, int], Translator]] = {}
+        self.lock = asyncio.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.loads = 0
+
+    def table(self, filename: str, flat: bool=False):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        seen = (stat.st_mtime_ns, stat.st_size)
+        loaded = self.tables.get(path)
+        if loaded is not None and loaded[0] == seen:
+            return loaded[1]
+        if flat:
+            translator = Translator.fromFile(path, self.cacheSize, self.cached, flat=True)
+        else:
+            translator = Translator.fromFile(path, cached=self.cached)
+        self.tables[path] = (seen, translator)
+        self.loads += 1
+        return translator
+
+    def translate(self, request: dict):
+        # The reply to a request, short of its id
+        start = timer()
+        target = request.get("target", self.target)
+        if target is None:
+            raise ValueError("No target given")
+        translator = self.table(self.URCLtranslations, True)
+        translatorISA = self.table(target)
+        if "source" in request:
+            main = Program.parse(request["source"].splitlines())
+        elif "file" in request:
+            main = Program.parseFile(request["file"])
+        else:
+            raise ValueError("Give the URCL as 'source' or 'file'")
+        read = len(main.code)
+        main = translator.translate(main)
+        main.makeRegsNumeric()
+        main.relativesToLabels()
+        reply = {"instructions": read, "core": len(main.code)}
+        if "output" in request:
+            with open(request["output"], "w+") as f:
+                translatorISA.writeISA(main, f)
+        else:
+            out = io.StringIO()
+            translatorISA.writeISA(main, out)
+            reply["output"] = out.getvalue()
+        reply["time"] = timer() - start
+        return reply
+
+    async def handle(self, line: bytes):
+        self.requests += 1
+        ident = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request is a JSON object")
+            ident = request.get("id")
+            async with self.lock:
+                reply = await asyncio.get_running_loop().run_in_executor(None, self.translate, request)
+        except Exception as e:
+            self.failed += 1
+            reply = {"error": f"{type(e).__name__}: {e}"}
+        return json.dumps({"id": ident, **reply}) + "\n"
+
+    async def serve(self, reader: asyncio.StreamReader, write):
+        # Answers every request from reader as soon as it's done, which need
+        # not be in the order they came in
+        tasks: set[asyncio.Task] = set()
+
+        async def answer(line: bytes):
+            write(await self.handle(line))
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(answer(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def serveStdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        def write(text: str):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        await self.serve(reader, write)
+
+    async def serveSocket(self, path: str):
+        async def connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await self.serve(reader, lambda text: writer.write(text.encode()))
+                await writer.drain()
+            finally:
+                writer.close()
+
+        Server.unlinkSocket(path)
+        server = await asyncio.start_unix_server(connection, path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            Server.unlinkSocket(path)
+
+    @staticmethod
+    def unlinkSocket(path: str):
+        # Removes a socket left at path, anything else there is left alone
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise ValueError(f"Cannot listen on '{path}', something that isn't a socket is there.")
+        os.remove(path)
+
+    def run(self, address: str):
+        # '-' serves stdin/stdout until stdin closes, anything else is the path
+        # of a Unix socket to serve until interrupted
+        if address == "-":
+            asyncio.run(self.serveStdio())
+        else:
+            # Fails before serving anything if address is taken
+            Server.unlinkSocket(address)
+            asyncio.run(self.serveSocket(address))
+
+    def toString(self):
+        return f"{self.requests} requests ({self.failed} failed), {self.loads} tables loaded."
@@ -0,0 +1,325 @@
+from timeit import default_timer as timer
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Header
+from folding import Folder
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from translator import Translator
+
+class Simulator():
+    # Runs URCL, core or not, to measure what code does and how long it takes.
+    # Every instruction is decoded once into a closure that does its work and
+    # returns the index of the next one, or None to halt, so running is a loop
+    # over a list of them. Every operand is read from one list of slots: R0, SP,
+    # a slot writes to R0 go to, then every register and every immediate as
+    # they're first used, immediates holding their value and never written.
+    # Values wrap around at the word size, from the BITS header if it has one,
+    # and the operations are the ones constant folding does. Labels are the
+    # index of the instruction they're on, and memory is one list: DW data at
+    # the index it's at, 'M' operands at their own address, and the stack at
+    # the top, growing down. A jump to itself halts, as that's what HLT is
+    # lowered to, as does one back over nothing but IMMs, which is how it's
+    # lowered when the target is loaded into a register first. Ports are
+    # handled by functions of the port's name, inputs returning a value and
+    # outputs taking one, by default reading 0 and keeping what's written in
+    # output.
+
+    # Values of a port toString shows
+    shown = 32
+
+    def __init__(self, program: Program, wordSize: int=8, inputs: "dict | None"=None, outputs: "dict | None"=None, memory: int=1 << 12):
+        wordSize = Program.wordSize(program.headers, wordSize)
+        self.wordSize = wordSize
+        self.mask = (1 << wordSize) - 1
+        self.code = program.code
+        self.inputs = {} if inputs is None else inputs
+        self.outputs = {} if outputs is None else outputs
+        self.output: dict[str, list[int]] = {}
+        heap = int(program.headers.get(Header.MINHEAP.value, ["0"])[-1])
+        stack = int(program.headers.get(Header.MINSTACK.value, ["0"])[-1])
+        self.memory = [0] * max(memory, len(self.code) + heap + stack)
+        self.labels: dict[str, int] = {}
+        for i,ins in enumerate(self.code):
+            for label in ins.labels:
+                self.labels.setdefault(label.lstrip("."), i)
+        self.slots: list[int] = [0]
+        self.registers: dict = {0: 0, "0": 0}
+        self.constants: dict[int, int] = {}
+        self.sp = self.slot(Operand(OpType.STACKPTR, "SP"))
+        self.slots[self.sp] = len(self.memory)
+        # Writes to R0 go nowhere
+        self.sink = len(self.slots)
+        self.slots.append(0)
+        self.steps = [self.decode(i, ins) for i,ins in enumerate(self.code)]
+        # What the last run did
+        self.counts = [0] * len(self.code)
+        self.executed = 0
+        self.halted = False
+        self.time = 0.0
+        self.costs: "list[int] | None" = None
+
+    def slot(self, opr: Operand):
+        # Index of the slot an operand is read from
+        if opr.type in [OpType.REGISTER, OpType.STACKPTR]:
+            slot = self.registers.get(opr.value)
+            if slot is None:
+                slot = self.registers[opr.value] = len(self.slots)
+                self.slots.append(0)
+            return slot
+        value = self.value(opr)
+        slot = self.constants.get(value)
+        if slot is None:
+            slot = self.constants[value] = len(self.slots)
+            self.slots.append(value)
+        return slot
+
+    def target(self, opr: Operand):
+        # Index of the slot a write to an operand goes to
+        if opr.type == OpType.REGISTER and opr.value in [0, "0"]:
+            return self.sink
+        if opr.type not in [OpType.REGISTER, OpType.STACKPTR]:
+            raise ValueError(f"Cannot simulate a write to '{opr.toString()}', it isn't a register.")
+        return self.slot(opr)
+
+    def value(self, opr: Operand):
+        if opr.type == OpType.LABEL:
+            name = opr.value.split("[")[0]
+            if name not in self.labels:
+                raise ValueError(f"Cannot simulate a jump to '{opr.toString()}', there's no such label.")
+            address = self.labels[name]
+            return (address >> (opr.word * self.wordSize)) & self.mask if "[" in opr.value else address
+        if opr.type == OpType.ADDRESS:
+            return int(opr.value)
+        if opr.type == OpType.NEGATIVE:
+            return -int(opr.value) & self.mask
+        if opr.type == OpType.NUMBER:
+            return int(opr.value) & self.mask
+        raise ValueError(f"Cannot simulate operand '{opr.toString()}'.")
+
+    def decode(self, i: int, ins: Instruction):
+        # The closure that runs ins
+        slots = self.slots
+        memory = self.memory
+        mask = self.mask
+        w = self.wordSize
+        sp = self.sp
+        opcode = ins.opcode
+        # Relative jumps go to an index, like labels
+        operands = [Operand(OpType.ADDRESS, str(i + int(opr.value))) if opr.type == OpType.RELATIVE else opr for opr in ins.operands]
+        following = i + 1
+        def need(count: int, most: "int | None"=None):
+            # Operands past count are ones the URCL table ignores too, like
+            # the last of 'BNZ :: A A A'
+            if not count <= len(operands) <= (count if most is None else most):
+                raise ValueError(f"Cannot simulate {opcode} with {len(operands)} operands.")
+        # Landing anywhere from idle to here, with only IMMs in between, goes
+        # round for ever without anything changing
+        idle = i
+        while idle > 0 and self.code[idle-1].opcode == "IMM":
+            idle -= 1
+        def jumpsHere():
+            return operands[0].type in [OpType.LABEL, OpType.ADDRESS] and idle <= self.value(operands[0]) <= i
+
+        if opcode in ["NOP", "DW"]:
+            if opcode == "DW":
+                for o,opr in enumerate(operands):
+                    if i + o < len(memory):
+                        memory[i + o] = self.value(opr) if opr.type != OpType.OTHER else 0
+            return lambda: following
+        if opcode == "HLT":
+            return lambda: None
+        f = Folder.unary.get(opcode)
+        if f is not None:
+            need(2)
+            d, b = self.target(operands[0]), self.slot(operands[1])
+            def step():
+                slots[d] = f(slots[b], w) & mask
+                return following
+            return step
+        f = Folder.binary.get(opcode)
+        if f is not None:
+            need(3)
+            d, b, c = self.target(operands[0]), self.slot(operands[1]), self.slot(operands[2])
+            if opcode in ["DIV", "MOD"]:
+                def step():
+                    divisor = slots[c]
+                    slots[d] = f(slots[b], divisor, w) & mask if divisor else mask
+                    return following
+            else:
+                def step():
+                    slots[d] = f(slots[b], slots[c], w) & mask
+                    return following
+            return step
+        f = Folder.comparisons.get(opcode)
+        if f is not None:
+            need(3)
+            t, b, c = self.slot(operands[0]), self.slot(operands[1]), self.slot(operands[2])
+            if opcode == "BGE" and b == c:
+                # Always taken, a halt if it goes round for ever
+                if jumpsHere():
+                    return lambda: None
+                return lambda: None if idle <= slots[t] <= i else slots[t]
+            return lambda: slots[t] if f(slots[b], slots[c], w) else following
+        f = Folder.tests.get(opcode)
+        if f is not None:
+            need(2, 3)
+            t, b = self.slot(operands[0]), self.slot(operands[1])
+            return lambda: slots[t] if f(slots[b], w) else following
+        if opcode == "JMP":
+            need(1, 2)
+            if jumpsHere():
+                return lambda: None
+            t = self.slot(operands[0])
+            return lambda: None if idle <= slots[t] <= i else slots[t]
+        if opcode == "LOD":
+            need(2)
+            d, a = self.target(operands[0]), self.slot(operands[1])
+            def step():
+                slots[d] = memory[slots[a]]
+                return following
+            return step
+        if opcode == "STR":
+            need(2)
+            a, v = self.slot(operands[0]), self.slot(operands[1])
+            def step():
+                memory[slots[a]] = slots[v]
+                return following
+            return step
+        if opcode == "LLOD":
+            need(3)
+            d, a, b = self.target(operands[0]), self.slot(operands[1]), self.slot(operands[2])
+            def step():
+                slots[d] = memory[slots[a] + slots[b] & mask]
+                return following
+            return step
+        if opcode == "LSTR":
+            need(3)
+            a, b, v = self.slot(operands[0]), self.slot(operands[1]), self.slot(operands[2])
+            def step():
+                memory[slots[a] + slots[b] & mask] = slots[v]
+                return following
+            return step
+        if opcode == "CPY":
+            need(2)
+            a, b = self.slot(operands[0]), self.slot(operands[1])
+            def step():
+                memory[slots[a]] = memory[slots[b]]
+                return following
+            return step
+        if opcode == "SDIV":
+            need(3)
+            d, b, c = self.target(operands[0]), self.slot(operands[1]), self.slot(operands[2])
+            def step():
+                x, y = Folder.signed(slots[b], w), Folder.signed(slots[c], w)
+                slots[d] = (abs(x) // abs(y) * (1 if (x < 0) == (y < 0) else -1) if y else -1) & mask
+                return following
+            return step
+        if opcode == "PSH":
+            need(1)
+            v = self.slot(operands[0])
+            def step():
+                slots[sp] -= 1
+                memory[slots[sp]] = slots[v]
+                return following
+            return step
+        if opcode == "POP":
+            need(1)
+            d = self.target(operands[0])
+            def step():
+                slots[d] = memory[slots[sp]]
+                slots[sp] += 1
+                return following
+            return step
+        if opcode == "CAL":
+            need(1)
+            t = self.slot(operands[0])
+            def step():
+                slots[sp] -= 1
+                memory[slots[sp]] = following
+                return slots[t]
+            return step
+        if opcode == "RET":
+            def step():
+                slots[sp] += 1
+                return memory[slots[sp] - 1]
+            return step
+        if opcode == "OUT":
+            need(2)
+            port, v = operands[0].value, self.slot(operands[1])
+            handler = self.outputs.get(port)
+            if handler is None:
+                written = self.output.setdefault(port, [])
+                handler = written.append
+            def step():
+                handler(slots[v])
+                return following
+            return step
+        if opcode == "IN":
+            need(2)
+            d, port = self.target(operands[0]), operands[1].value
+            handler = self.inputs.get(port, lambda: 0)
+            def step():
+                slots[d] = handler() & mask
+                return following
+            return step
+        raise ValueError(f"Cannot simulate {opcode}, it isn't an instruction the simulator knows.")
+
+    def run(self, limit: int=10_000_000):
+        # Runs until the code halts or runs off the end, or limit instructions
+        # have run
+        start = timer()
+        steps = self.steps
+        counts = self.counts
+        end = len(steps)
+        pc = 0
+        executed = 0
+        while pc is not None and pc < end and executed < limit:
+            counts[pc] += 1
+            pc = steps[pc]()
+            executed += 1
+        self.halted = executed < limit
+        self.executed = executed
+        self.time = timer() - start
+        return self
+
+    def cost(self, translator: "Translator"):
+        # Cycles every instruction takes on a target: what the header of its
+        # case says, or a cycle for every line of ISA code
+        self.costs = []
+        for ins in self.code:
+            case = translator.case(Instruction(ins.opcode, list(ins.operands)))
+            if case is None:
+                self.costs.append(0)
+            elif case.cost is not None:
+                self.costs.append(case.cost[0])
+            else:
+                self.costs.append(sum(1 for head in case.output.heads if head))
+        return self.costs
+
+    def perOpcode(self):
+        counts: dict[str, int] = {}
+        for ins,count in zip(self.code, self.counts):
+            if count:
+                counts[ins.opcode] = counts.get(ins.opcode, 0) + count
+        return counts
+
+    def cycles(self):
+        if self.costs is None:
+            return None
+        return sum(count * cost for count,cost in zip(self.counts, self.costs))
+
+    def toString(self):
+        rate = self.executed / self.time if self.time else 0
+        state = "halted" if self.halted else "stopped at the limit"
+        out = f"Simulation: {self.executed} instructions in {self.time:.10f} seconds ({rate:.0f}/s), {state}"
+        cycles = self.cycles()
+        if cycles is not None:
+            out += f", {cycles} cycles"
+        for opcode,count in sorted(self.perOpcode().items(), key=lambda a: -a[1]):
+            out += f"\n{count:>10}  {opcode}"
+        for port,values in self.output.items():
+            out += f"\n%{port}: {' '.join(str(v) for v in values[:Simulator.shown])}"
+            if len(values) > Simulator.shown:
+                out += f" ... ({len(values) - Simulator.shown} more)"
+        return out
@@ -0,0 +1,102 @@
+from collections import deque
+from typing import TextIO
+from operand import Operand, OpType
+from instruction import Instruction
+from program import Program, Registers, Numbering
+from translator import Translator
+
+class Stream():
+    # Translates a program in a single pass with bounded memory. Every source
+    # instruction is read, expanded, numbered and written out as ISA before the
+    # rest of the file is looked at, only a window of recent core instructions
+    # is kept so relative jumps can still label what they point back to.
+    # Output is the same as translating the whole program at once, except that
+    # relative labels are numbered as they're met, which only shows when case
+    # bodies define labels of their own.
+    bufferSize = 1 << 20
+
+    def __init__(self, translator: Translator, translatorISA: Translator, window: int=4096):
+        self.translator = translator
+        self.translatorISA = translatorISA
+        self.window = window
+        self.headers: dict[int, str] = {}
+        self.registers = Registers()
+        self.numbering = Numbering()
+        self.uid = 0
+        self.read = 0
+        self.written = 0
+        self.buffer: "deque[Instruction]" = deque()
+        # How many labels each buffered instruction had before relative jumps
+        # added theirs
+        self.own: "deque[int]" = deque()
+        # Index of the first buffered instruction, and labels waiting for
+        # instructions that haven't been reached yet
+        self.base = 0
+        self.forward: dict[int, list[str]] = {}
+        # Jumps back past the start count from the end of the program, like a
+        # negative list index, as (target, uid, label)
+        self.wrapped: list[tuple[int, int, str]] = []
+
+    def run(self, lines, out: TextIO):
+        for ins in Program.tokenize(lines, registers=self.registers, headers=self.headers):
+            self.read += 1
+            self.numbering.begin(ins)
+            sub = Program([ins], registers=self.registers)
+            sub.uid = self.uid
+            self.translator.translate(sub)
+            self.uid = sub.uid
+            for core in sub.code:
+                self.numbering.number(core)
+                self.push(core, out)
+        if self.forward:
+            target = min(self.forward)
+            raise IndexError(f"Relative jump to core instruction {target} is past the end of the program")
+        total = self.base + len(self.buffer)
+        for target,uid,label in self.wrapped:
+            if target + total < 0:
+                raise IndexError(f"Relative jump to core instruction {target} is before the start of the program")
+            if target + total < self.base:
+                raise ValueError(f"Relative jump to core instruction {target} wraps around outside the streaming window of {self.window} instructions")
+            # Relative labels go in the order of the jumps they're for
+            b = target + total - self.base
+            labels = self.buffer[b].labels
+            at = self.own[b]
+            while at < len(labels) and int(labels[at].rsplit("_", 1)[1]) < uid:
+                at += 1
+            labels.insert(at, label)
+        while self.buffer:
+            self.emit(out)
+        out.flush()
+
+    def push(self, ins: Instruction, out: TextIO):
+        # Program.relativesToLabels for one instruction at a time
+        index = self.base + len(self.buffer)
+        self.buffer.append(ins)
+        self.own.append(len(ins.labels))
+        labels = self.forward.pop(index, None)
+        if labels is not None:
+            ins.labels += labels
+        for o,opr in enumerate(ins.operands):
+            if opr.type != OpType.RELATIVE:
+                continue
+            label = f"{ins.opcode}_{self.uid}"
+            target = index + int(opr.value)
+            if target > index:
+                self.forward.setdefault(target, []).append(label)
+            elif target >= self.base:
+                self.buffer[target - self.base].labels.append(label)
+            elif target < 0:
+                self.wrapped.append((target, self.uid, label))
+            else:
+                raise ValueError(f"Relative jump from core instruction {index} back to {target} is outside the streaming window of {self.window} instructions")
+            ins.operands[o] = Operand.parse(f".{label}")
+            self.uid += 1
+        while len(self.buffer) > self.window:
+            self.emit(out)
+
+    def emit(self, out: TextIO):
+        ins = self.buffer.popleft()
+        self.own.popleft()
+        self.base += 1
+        self.written += 1
+        out.write(f"{' '.join(ins.labels)} | {self.translatorISA.substituteText(ins)}\n")
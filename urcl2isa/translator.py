@@ -1,41 +1,326 @@
 from typing import TYPE_CHECKING
-from operand import OpType
-from UTRX import Translation
-from program import Program
-if TYPE_CHECKING: from instruction import Instruction
+from UTRX import Translation, Case, Body, Sizes, CPU
+from profiler import MatchStats
+from program import Program, Registers
+from isa import Block
+from cache import ExpansionCache, Template
+from flatten import Flattener
+from timeit import default_timer as timer
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import os
+import pickle
+if TYPE_CHECKING:
+    from instruction import Instruction
+    from operand import Operand
+    from selector import Selector
+
+# The translator and code of a worker process in a parallel translateISA
+worker: "tuple[Translator, list[Instruction]] | None" = None
+
+def initWorker(translator: "Translator", code: list["Instruction"]):
+    global worker
+    worker = (translator, code)
+
+def translateShard(start: int, end: int):
+    # Each block's code comes back as one string, which is much cheaper to send
+    # between processes than lists of them
+    translator, code = worker
+    return ["\n".join(translator.substitute(ins)) for ins in code[start:end]]
+
 class Translator():
-    def __init__(self, translations: dict[str, Translation]):
+    # Bump whenever the pickled layout of Translation/Case/Pattern changes
+    tableVersion = 9
+
+    def __init__(self, translations: dict[str, Translation], cacheSize: int=4096, sizes: "Sizes | None"=None, cpu: "CPU | None"=None):
         self.translations = translations
+        # Words per line of code, for replacing labels with addresses
+        self.sizes = Sizes() if sizes is None else sizes
+        # Stats of the target, like how many registers it has
+        self.cpu = CPU() if cpu is None else cpu
+        # Seconds spent getting the tables, and how many of the seconds it would
+        # have taken to parse them were saved by the table cache
+        self.loadTime = 0.0
+        self.savedTime = 0.0
+        # Registers can only be told apart by identity unless some case tests
+        # operand values, then the expansion cache has to key them by value
+        exact = any(pattern is not None and not pattern.typeOnly
+                    for translation in translations.values()
+                    for case in translation.cases
+                    for pattern in case.patterns)
+        self.cache = ExpansionCache(cacheSize, exact)
+        # Match statistics are only kept when there's somewhere to put them
+        self.stats: "MatchStats | None" = None
+        # Picks instructions the target should get as they are, if set
+        self.selector: "Selector | None" = None
+        # Chains of cases that never stop expanding, found flattening the tables
+        self.cycles: list[str] = []
 
-    def substitute(self, ins: "Instruction"):
-        translation = self.translations.get(ins.opcode)
-        if translation is None:
+    def substitute(self, ins: "Instruction", names: "dict[Operand, str] | None"=None):
+        case = self.case(ins)
+        if case is None:
             return ""
-        body = ins.match(translation)
-        if body is None:
+        return case.output.render(Translator.texts(ins, names))
+
+    def substituteText(self, ins: "Instruction", names: "dict[Operand, str] | None"=None):
+        # The same, as the code of a block in an output file
+        case = self.case(ins)
+        if case is None:
             return ""
-        for l,line in enumerate(body):
-            for i in range(len(ins.operands)):
-                body[l] = body[l].replace(f"@{chr(65+i)}", ins.operands[i].toString())
-        return body
+        return case.output.renderText(Translator.texts(ins, names))
 
-    def substituteURCL(self, ins: "Instruction", wordSize: int=8):
+    @staticmethod
+    def texts(ins: "Instruction", names: "dict[Operand, str] | None"=None):
+        # Operands are shared and never change, so while they're all alive their
+        # text can be remembered by identity in names
+        if names is None:
+            return [opr.toString() for opr in ins.operands]
+        texts = []
+        for opr in ins.operands:
+            text = names.get(opr)
+            if text is None:
+                text = opr.toString()
+                names[opr] = text
+            texts.append(text)
+        return texts
+
+    def case(self, ins: "Instruction"):
+        if self.stats is not None:
+            self.stats.visit(ins.opcode, 0)
+        translation = self.translations.get(ins.opcode)
+        if translation is None:
+            return None
+        return ins.matchCase(translation, self.stats)
+
+    def substituteURCL(self, ins: "Instruction", registers: "Registers | None"=None, wordSize: int=8):
+        # Instantiates the matching case body, with fresh temporaries taken from
+        # registers
         translation = self.translations.get(ins.opcode)
         if translation is None:
             return ""
-        body = ins.match(translation)
-        if body is None:
+        case = ins.matchCase(translation, self.stats)
+        if case is None:
             return ""
-        sub = Program.parse(body, wordSize)
-        for i,instr in enumerate(sub.code):
-            for o,opr in enumerate(instr.operands):
-                if opr.type == OpType.OTHER:
-                    if opr.value.isalpha() and len(opr.value) == 1:
-                        placeholder = ins.operands[ord(opr.value)-65]
-                        opr.extra[opr.value] = placeholder
-        return sub
+        if registers is None:
+            registers = Registers()
+        return Translator.body(case).instantiate(ins.operands, registers, wordSize)
+
+    @staticmethod
+    def body(case: Case):
+        if case.body is None:
+            # Only reachable for bodies that aren't URCL, raises the parse error
+            return Body.parse(case.code)
+        return case.body
+
+    def translate(self, program: Program):
+        # Expand every instruction to a fixpoint in place. Programs are linked
+        # while they're expanded so splicing a sub-program in is O(1), and each
+        # one is scanned once through a node cursor that stays valid across
+        # splices. Sub-programs wait on an explicit stack of frames instead of
+        # recursing, and everything before a cursor is already fully expanded.
+        # Each frame is [program, node, cache key, operands, select, rule], the
+        # cache key and operands say where to file the finished sub-program in
+        # the cache, select whether the selector gets a say in the frame, and
+        # rule is the (opcode, case) it's the body of. Flattened bodies are
+        # used unless the selector has to see every step, and final ones are
+        # spliced in without a frame of their own. An instruction with
+        # the same cache key as one it's being expanded for would expand the
+        # same way again and again, so that's an error.
+        cache = self.cache
+        stats = self.stats
+        selector = self.selector
+        if selector is not None:
+            selector.pin(program.code)
+        program.link()
+        stack = [[program, program.code.head, None, None, selector is not None, None]]
+        expanding: set[tuple] = set()
+        while True:
+            frame = stack[-1]
+            prog, node = frame[0], frame[1]
+            if node is not None:
+                ins = node.ins
+                if stats is not None:
+                    stats.visit(ins.opcode, len(stack) - 1)
+                key = cache.signature(ins) if cache.maxSize else None
+                select = False
+                if selector is not None:
+                    select = frame[4] and selector.selects(ins)
+                    # What an instruction expands to depends on that then
+                    if key:
+                        key = (select, *key)
+                entry = cache.get(key) if key else False
+                if entry is not False:
+                    cache.hits += 1
+                    frame[1] = node.next
+                    if entry is not None:
+                        sub = entry.instantiate(ins.operands, program.registers)
+                        sub.link()
+                        prog.spliceSub(sub, node)
+                    continue
+                if key:
+                    cache.misses += 1
+                if select and selector.keep(ins):
+                    if key:
+                        cache.put(key, None)
+                    frame[1] = node.next
+                    continue
+                operands = list(ins.operands)
+                translation = self.translations.get(ins.opcode)
+                case = None if translation is None else ins.matchCase(translation, stats)
+                if case is None:
+                    if key:
+                        cache.put(key, None)
+                    frame[1] = node.next
+                    continue
+                body = case.flat if case.flat is not None and selector is None else Translator.body(case)
+                if body.final:
+                    # Nothing in it expands, so it goes in as it is
+                    sub = body.instantiate(ins.operands, program.registers)
+                    if key:
+                        cache.put(key, Template(sub, operands))
+                    sub.link()
+                    frame[1] = node.next
+                    prog.spliceSub(sub, node)
+                    continue
+                if key:
+                    if key in expanding:
+                        first = next(f for f,other in enumerate(stack) if other[2] == key)
+                        chain = [f"{opcode} :: {rule.string.strip()}" for opcode,rule in (other[5] for other in stack[first:])]
+                        chain.append(f"{ins.opcode} :: {case.string.strip()}")
+                        raise ValueError(f"Cannot expand {ins.opcode}, it never stops expanding: {' -> '.join(chain)}")
+                    expanding.add(key)
+                sub = body.instantiate(ins.operands, program.registers)
+                sub.link()
+                stack.append([sub, sub.code.head, key, operands, select and selector.free(sub.code), (ins.opcode, case)])
+                continue
+            stack.pop()
+            if not stack:
+                program.flatten()
+                return program
+            key, operands = frame[2:4]
+            if key:
+                expanding.discard(key)
+                cache.put(key, Template(prog, operands))
+            parent = stack[-1]
+            node = parent[1]
+            parent[1] = node.next
+            parent[0].spliceSub(prog, node)
+
+    def translateISA(self, program: Program, jobs: int=1):
+        # With more than one job the program is cut into contiguous shards that
+        # a pool of processes translates. Workers get the translator and code
+        # once, for free where they can be forked, and then only shard bounds.
+        # Match statistics can't be collected across processes
+        code = program.code
+        if jobs <= 1 or len(code) < 2 or self.stats is not None:
+            return self.translateCode(code)
+        shards = min(len(code), jobs * 4)
+        size = -(-len(code) // shards)
+        starts = range(0, len(code), size)
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        out: list[Block] = []
+        with ProcessPoolExecutor(jobs, context, initWorker, (self, code)) as pool:
+            for start,blocks in zip(starts, pool.map(translateShard, starts, [s + size for s in starts])):
+                for i,block in enumerate(blocks, start):
+                    out.append(Block(code[i].labels, block.split("\n")))
+        return out
+
+    def translateCode(self, code: list["Instruction"]):
+        # Instructions with the same opcode and the very same operands come out
+        # the same, and numbering and the expansion cache share operands a lot.
+        # Unless every match has to be counted, each is only translated once.
+        out: list[Block] = []
+        done: dict[tuple, "list[str] | str"] = {}
+        names: dict[Operand, str] = {}
+        for ins in code:
+            key = (ins.opcode, *ins.operands)
+            body = done.get(key)
+            if body is None:
+                body = self.substitute(ins, names)
+                if self.stats is None:
+                    done[key] = body
+            out.append(Block(ins.labels, body))
+        return out
+
+    def writeISA(self, program: Program, out, chunk: int=4096):
+        # translateISA straight into a file, rendered like Block.toString()
+        # without building the blocks, and written a chunk of blocks at a time
+        done: dict[tuple, str] = {}
+        names: dict[Operand, str] = {}
+        parts: list[str] = []
+        for ins in program.code:
+            key = (ins.opcode, *ins.operands)
+            text = done.get(key)
+            if text is None:
+                text = self.substituteText(ins, names)
+                if self.stats is None:
+                    done[key] = text
+            parts.append(f"{' '.join(ins.labels)} | {text}\n")
+            if len(parts) >= chunk:
+                out.write("".join(parts))
+                parts.clear()
+        out.write("".join(parts))
+
+    @staticmethod
+    def tablePath(filename: str, flat: bool=False):
+        # Compiled tables live next to the UTRX file, like Python's own bytecode
+        folder, name = os.path.split(os.path.abspath(filename))
+        return os.path.join(folder, "__pycache__", f"{name}{'.flat' if flat else ''}.v{Translator.tableVersion}.pickle")
 
     @staticmethod
-    def fromFile(filename):
+    def fromFile(filename, cacheSize: int=4096, cached: bool=True, flat: bool=False):
+        # Parsed and compiled tables are pickled along with a hash of the UTRX
+        # source, later runs load them back unless the source has changed.
+        # Tables to expand URCL with can be flattened, targets translate every
+        # instruction once and have nothing to gain from it.
+        start = timer()
+        with open(filename, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        path = Translator.tablePath(filename, flat)
+        if cached:
+            try:
+                with open(path, "rb") as f:
+                    table = pickle.load(f)
+                if table["version"] == Translator.tableVersion and table["hash"] == digest:
+                    translator = Translator(table["translations"], cacheSize, table["sizes"], table["cpu"])
+                    translator.cycles = table["cycles"]
+                    translator.loadTime = timer() - start
+                    translator.savedTime = table["parseTime"] - translator.loadTime
+                    return translator
+            except Exception:
+                # Missing, stale or unreadable, just parse the file again
+                pass
         translations = Translation.parseFile(filename)
-        return Translator(translations)
\ No newline at end of file
+        sizes = Sizes.parseFile(filename)
+        cpu = CPU.parseFile(filename)
+        cycles: list[str] = []
+        if flat:
+            flattener = Flattener(translations)
+            flattener.run()
+            cycles = flattener.cycles
+        translator = Translator(translations, cacheSize, sizes, cpu)
+        translator.cycles = cycles
+        translator.loadTime = timer() - start
+        if cached:
+            table = {
+                "version": Translator.tableVersion,
+                "hash": digest,
+                "parseTime": translator.loadTime,
+                "translations": translations,
+                "sizes": sizes,
+                "cpu": cpu,
+                "cycles": cycles,
+            }
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename, so concurrent runs never see half a file
+                temp = f"{path}.{os.getpid()}.tmp"
+                with open(temp, "wb") as f:
+                    pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(temp, path)
+            except OSError:
+                pass
+        return translator
\ No newline at end of file